@@ -0,0 +1,136 @@
+import itertools
+import logging
+import math
+import time
+from argparse import ArgumentParser
+
+from datasets import disable_caching, load_dataset
+from filter_data import get_thresholds
+from filters import get_compression_ratio_fn
+
+logger = logging.getLogger(__name__)
+disable_caching()
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--input_path",
+        type=str,
+        nargs="+",
+        help="Path(s) to the input JSONL file(s).",
+    )
+    parser.add_argument(
+        "--max_examples",
+        type=int,
+        default=None,
+        help="Maximum number of examples to use (all by default).",
+    )
+    parser.add_argument(
+        "--strict",
+        action="store_true",
+        help="Whether to use the thresholds of strict filtering.",
+    )
+    parser.add_argument(
+        "--codec",
+        type=str,
+        nargs="+",
+        default=["zlib"],
+        choices=["zlib", "zstd"],
+        help="Codec(s) to compare.",
+    )
+    parser.add_argument(
+        "--level",
+        type=int,
+        nargs="+",
+        default=[1, 3, 6, 9],
+        help="Compression level(s) to compare.",
+    )
+    parser.add_argument(
+        "--max_bytes",
+        type=int,
+        nargs="+",
+        default=[0, 4_096, 16_384],
+        help="Maximum bytes to compress (0 means no limit) to compare.",
+    )
+    parser.add_argument(
+        "--num_windows",
+        type=int,
+        nargs="+",
+        default=[1, 4],
+        help="Number(s) of windows to compress to compare.",
+    )
+    args = parser.parse_args()
+
+    logger.info("Loading the dataset")
+    dataset = load_dataset(
+        "json", data_files=args.input_path, split="train", streaming=True
+    )
+    if args.max_examples is not None:
+        dataset = dataset.take(args.max_examples)
+    # Empty texts are rejected by `is_not_empty` before the compression ratio.
+    encoded_texts: list[bytes] = [
+        example["text"].encode("utf-8")
+        for example in dataset
+        if example["text"].strip() != ""
+    ]
+    num_bytes = sum(len(encoded) for encoded in encoded_texts)
+    logger.info(f"Loaded {len(encoded_texts):,} examples ({num_bytes:,} bytes).")
+
+    thresholds = get_thresholds(args.strict)
+
+    def judge(ratio: float, encoded_length: int) -> bool:
+        length_factor = thresholds["compression_length_factor"]
+        length_penalty = (
+            length_factor * math.log(encoded_length) if length_factor else 0.0
+        )
+        score = ratio + length_penalty
+        return (
+            thresholds["min_compression_ratio"]
+            <= score
+            <= thresholds["max_compression_ratio"]
+        )
+
+    get_reference_ratio = get_compression_ratio_fn()
+    reference = [
+        judge(get_reference_ratio(encoded), len(encoded)) for encoded in encoded_texts
+    ]
+
+    print(
+        "codec | level | max_bytes | num_windows | docs/s | MB/s | agreement "
+        "| accepted->rejected | rejected->accepted"
+    )
+    for codec, level, max_bytes, num_windows in itertools.product(
+        args.codec, args.level, args.max_bytes, args.num_windows
+    ):
+        if max_bytes == 0 and num_windows > 1:
+            continue
+        get_ratio = get_compression_ratio_fn(
+            codec=codec,
+            level=level,
+            max_bytes=max_bytes or None,
+            num_windows=num_windows,
+        )
+        start_time = time.perf_counter()
+        ratios = [get_ratio(encoded) for encoded in encoded_texts]
+        elapsed_time = time.perf_counter() - start_time
+        decisions = [
+            judge(ratio, len(encoded)) for ratio, encoded in zip(ratios, encoded_texts)
+        ]
+        num_rejected = sum(1 for r, d in zip(reference, decisions) if r and not d)
+        num_accepted = sum(1 for r, d in zip(reference, decisions) if not r and d)
+        agreement = 1 - (num_rejected + num_accepted) / len(encoded_texts)
+        print(
+            f"{codec} | {level} | {max_bytes or '-'} | {num_windows} "
+            f"| {len(encoded_texts) / elapsed_time:,.0f} "
+            f"| {num_bytes / elapsed_time / 1e6:,.1f} "
+            f"| {agreement:.4f} | {num_rejected:,} | {num_accepted:,}"
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(name)s:%(lineno)d: %(levelname)s: %(message)s",
+    )
+    main()
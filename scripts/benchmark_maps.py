@@ -0,0 +1,177 @@
+import logging
+import time
+from argparse import ArgumentParser
+from typing import Callable
+
+import regex
+from datasets import disable_caching, load_dataset
+from filters import (
+    get_clean_wikipedia_texts,
+    get_japanese_texts,
+    get_text_without_empty_parenthesis,
+    get_text_without_wikipedia_footnote,
+)
+
+logger = logging.getLogger(__name__)
+disable_caching()
+
+
+def reference_extract_japanese_text(text: str) -> str:
+    # The original implementation of `filters.extract_japanese_text`.
+    ja_pat = regex.compile(r"[\p{Script=Hiragana}\p{Script=Katakana}ー]+")
+    script_pat = regex.compile(
+        r"[\u0000-\u007F\u0020-\u002F\u003A-\u0040\u005B-\u0060\u007B-\u007E]{100,}"
+    )
+    url_pat = regex.compile(r"https?://[\w/:%#\$&\?\(\)~\.=\+\-]+")
+
+    def regex_filter(sentence: str, pat) -> str:
+        valid: str = ""
+        index: int = 0
+        for m in pat.finditer(sentence):
+            valid += sentence[index : m.start()]
+            index = m.end()
+        valid += sentence[index:]
+        return valid
+
+    valid: str = ""
+    for sentence in text.split("\n"):
+        if ja_pat.search(sentence):
+            sentence = regex_filter(sentence, url_pat)
+            sentence = regex_filter(sentence, script_pat)
+            valid += sentence
+    return valid
+
+
+def reference_remove_wikipedia_footnote(text: str) -> str:
+    # The original implementation of `filters.remove_wikipedia_footnote`.
+    footnote_sections: list[str] = [
+        "脚注",
+        "関連項目",
+        "日本国内の関連項目",
+        "出典",
+        "出典・脚注",
+        "参照",
+        "外部リンク",
+        "参考文献",
+        "その他関連事項",
+        "Footnotes",
+        "See also",
+        "Further reading",
+        "Bibliography",
+        "References",
+        "Notes",
+        "Citations",
+        "Sources",
+        "External links",
+    ]
+    footnote_pat = regex.compile(rf"\n({'|'.join(footnote_sections)})\s*\n")
+    m = footnote_pat.search(text)
+    if m:
+        text = text[: m.start()]
+    return text
+
+
+def reference_remove_empty_parenthesis(text: str) -> str:
+    # The original implementation of `filters.remove_empty_parenthesis`.
+    # Japanese
+    text = regex.sub(r"（[\s,，、;；]*", "（", text)
+    text = regex.sub(r"[\s,，、;；]*）", "）", text)
+    text = regex.sub(r"（\s*）", "", text)
+    # English
+    text = regex.sub(r"\([\s,;]*", "(", text)
+    text = regex.sub(r"[\s,;]*\)", ")", text)
+    text = regex.sub(r"\s?\(\s*\)", "", text)
+    return text
+
+
+def reference_clean_wikipedia_text(text: str) -> str:
+    return reference_remove_empty_parenthesis(reference_remove_wikipedia_footnote(text))
+
+
+# Name -> (current batched implementation, reference implementation)
+MAP_FNS: dict[str, tuple[Callable[[list[str]], list[str]], Callable[[str], str]]] = {
+    "extract_japanese_text": (get_japanese_texts, reference_extract_japanese_text),
+    "remove_wikipedia_footnote": (
+        lambda texts: [get_text_without_wikipedia_footnote(text) for text in texts],
+        reference_remove_wikipedia_footnote,
+    ),
+    "remove_empty_parenthesis": (
+        lambda texts: [get_text_without_empty_parenthesis(text) for text in texts],
+        reference_remove_empty_parenthesis,
+    ),
+    "clean_wikipedia_text": (
+        get_clean_wikipedia_texts,
+        reference_clean_wikipedia_text,
+    ),
+}
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument(
+        "MAP_NAME",
+        type=str,
+        choices=list(MAP_FNS.keys()),
+        help="Name of the map function.",
+    )
+    parser.add_argument(
+        "--input_path",
+        type=str,
+        nargs="+",
+        help="Path(s) to the input JSONL file(s).",
+    )
+    parser.add_argument(
+        "--text_field",
+        type=str,
+        default="text",
+        help="Field of the text.",
+    )
+    parser.add_argument(
+        "--max_examples",
+        type=int,
+        default=None,
+        help="Maximum number of examples to use (all by default).",
+    )
+    args = parser.parse_args()
+
+    logger.info("Loading the dataset")
+    dataset = load_dataset(
+        "json", data_files=args.input_path, split="train", streaming=True
+    )
+    if args.max_examples is not None:
+        dataset = dataset.take(args.max_examples)
+    texts: list[str] = [example[args.text_field] for example in dataset]
+    num_chars = sum(len(text) for text in texts)
+    logger.info(f"Loaded {len(texts):,} examples ({num_chars:,} characters).")
+
+    map_fn, reference_fn = MAP_FNS[args.MAP_NAME]
+
+    start_time = time.perf_counter()
+    reference_outputs = [reference_fn(text) for text in texts]
+    reference_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    outputs = map_fn(texts)
+    elapsed_time = time.perf_counter() - start_time
+
+    num_mismatches = 0
+    for index, (output, reference_output) in enumerate(zip(outputs, reference_outputs)):
+        if output != reference_output:
+            if num_mismatches == 0:
+                logger.error(f"The output of example {index} differs.")
+            num_mismatches += 1
+
+    print(f"- Reference: {len(texts) / reference_time:,.0f} docs/s")
+    print(f"- Current: {len(texts) / elapsed_time:,.0f} docs/s")
+    print(f"- Speedup: {reference_time / elapsed_time:.2f}x")
+    print(f"- Mismatches: {num_mismatches:,} / {len(texts):,}")
+    if num_mismatches > 0:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(name)s:%(lineno)d: %(levelname)s: %(message)s",
+    )
+    main()
@@ -0,0 +1,144 @@
+import logging
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def get_memory_usage(pid: int) -> int:
+    """Returns the memory of a process and its descendants in bytes. The proportional
+    set size (PSS) is used where available, so that the pages shared by forked
+    processes are counted once in total."""
+    children: dict[int, list[int]] = {}
+    for stat_file in pathlib.Path("/proc").glob("[0-9]*/stat"):
+        try:
+            fields = stat_file.read_text().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        children.setdefault(int(fields[1]), []).append(int(stat_file.parent.name))
+    total = 0
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        pids.extend(children.get(pid, []))
+        try:
+            for line in pathlib.Path(f"/proc/{pid}/smaps_rollup").open():
+                if line.startswith("Pss:"):
+                    total += int(line.split()[1]) * 1024
+                    break
+        except OSError:
+            try:
+                statm = pathlib.Path(f"/proc/{pid}/statm").read_text()
+            except OSError:
+                continue
+            total += int(statm.split()[1]) * PAGE_SIZE
+    return total
+
+
+def run(command: list[str], interval: float) -> tuple[float, int]:
+    """Runs `command` and returns the elapsed time and the peak memory usage."""
+    logger.info(" ".join(command))
+    start_time = time.perf_counter()
+    process = subprocess.Popen(
+        command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    peak_memory_usage = 0
+    while process.poll() is None:
+        peak_memory_usage = max(peak_memory_usage, get_memory_usage(process.pid))
+        time.sleep(interval)
+    elapsed_time = time.perf_counter() - start_time
+    if process.returncode != 0:
+        raise RuntimeError(f"{command} exited with {process.returncode}.")
+    return elapsed_time, peak_memory_usage
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--input_path",
+        type=str,
+        nargs="+",
+        help="Path(s) to the input data directory or file.",
+    )
+    parser.add_argument(
+        "--input_format",
+        type=str,
+        default="parquet",
+        choices=["jsonl", "parquet"],
+        help="Input format.",
+    )
+    parser.add_argument(
+        "--sentencepiece_model",
+        type=str,
+        required=True,
+    )
+    parser.add_argument(
+        "--num_proc",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes (of the process pool) and threads to compare.",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=0.1,
+        help="Interval in seconds to sample the memory usage.",
+    )
+    args = parser.parse_args()
+
+    tokenize_data = pathlib.Path(__file__).with_name("tokenize_data.py")
+    results: dict[str, tuple[float, int]] = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        output_dirs: dict[str, pathlib.Path] = {}
+        for name, options in [
+            ("Process pool", ["--num_proc", str(args.num_proc)]),
+            ("Threads", ["--num_threads", str(args.num_proc)]),
+        ]:
+            output_dirs[name] = pathlib.Path(work_dir, str(len(output_dirs)))
+            command = [
+                sys.executable,
+                str(tokenize_data),
+                "--input_path",
+                *args.input_path,
+                "--input_format",
+                args.input_format,
+                "--output_dir",
+                str(output_dirs[name]),
+                "--sentencepiece_model",
+                args.sentencepiece_model,
+                *options,
+            ]
+            results[name] = run(command, args.interval)
+
+        output_files = [sorted(path.glob("*.parquet")) for path in output_dirs.values()]
+        num_examples = sum(pq.read_metadata(path).num_rows for path in output_files[0])
+        num_mismatches = sum(
+            not pq.read_table(path).equals(pq.read_table(other_path))
+            for path, other_path in zip(*output_files)
+        )
+
+    for name, (elapsed_time, peak_memory_usage) in results.items():
+        print(
+            f"- {name}: {num_examples / elapsed_time:,.0f} docs/s, "
+            f"peak memory {peak_memory_usage / 2**20:,.0f} MiB"
+        )
+    print(f"- Mismatched files: {num_mismatches:,} / {len(output_files[0]):,}")
+    if num_mismatches > 0:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(name)s:%(lineno)d: %(levelname)s: %(message)s",
+    )
+    main()
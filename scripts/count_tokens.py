@@ -1,14 +1,75 @@
+import functools
+import json
 import logging
 import os
 import pathlib
+import re
 from argparse import ArgumentParser
+from multiprocessing import Pool
+from typing import Any
 
-from datasets import Dataset, disable_caching
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from indexed_dataset import read_index
 from tqdm import tqdm
-from utils import list_input_files
+from utils import list_input_files, read_jsonl_blocks
 
 logger = logging.getLogger(__name__)
-disable_caching()
+
+# Size [bytes] of a block of the JSONL input parsed at a time
+BLOCK_SIZE = 16 * 2**20
+# Columns the number of tokens is computed from, in the order of preference
+TOKEN_COLUMNS = ["num_tokens", "token_ids", "tokens"]
+
+
+def get_split(input_file: pathlib.Path) -> str:
+    """Returns the split of a shard, e.g., "train" for `train_0.parquet`."""
+    return re.sub(r"_\d+$", "", input_file.stem)
+
+
+def count_table_tokens(table: pa.Table, column: str) -> int:
+    if column == "num_tokens":
+        return pc.sum(table[column]).as_py() or 0
+    return pc.sum(pc.list_value_length(table[column])).as_py() or 0
+
+
+def count_file_tokens(input_file: pathlib.Path, input_format: str) -> dict[str, Any]:
+    """Counts the examples and the tokens of a file, reading only the column of the
+    numbers of tokens of parquet and the .idx file of Megatron-LM."""
+    num_examples = num_tokens = 0
+    if input_format == "parquet":
+        parquet_file = pq.ParquetFile(input_file)
+        column_names = parquet_file.schema_arrow.names
+        column = next((name for name in TOKEN_COLUMNS if name in column_names), None)
+        if column is None:
+            raise ValueError(f"{input_file} has none of {TOKEN_COLUMNS}.")
+        num_examples = parquet_file.metadata.num_rows
+        for index in range(parquet_file.num_row_groups):
+            table = parquet_file.read_row_group(index, columns=[column])
+            num_tokens += count_table_tokens(table, column)
+    elif input_format == "jsonl":
+        file_size = input_file.stat().st_size
+        for table, _ in read_jsonl_blocks(input_file, 0, file_size, BLOCK_SIZE):
+            column_names = table.column_names
+            column = next(
+                (name for name in TOKEN_COLUMNS if name in column_names), None
+            )
+            if column is None:
+                raise ValueError(f"{input_file} has none of {TOKEN_COLUMNS}.")
+            num_examples += table.num_rows
+            num_tokens += count_table_tokens(table, column)
+    else:
+        assert input_format == "idx"
+        _, sizes, _, _ = read_index(input_file)
+        num_examples = len(sizes)
+        num_tokens = int(sizes.sum(dtype="int64"))
+    return {
+        "file": str(input_file),
+        "split": get_split(input_file),
+        "num_examples": num_examples,
+        "num_tokens": num_tokens,
+    }
 
 
 def main() -> None:
@@ -23,8 +84,14 @@ def main() -> None:
         "--input_format",
         type=str,
         default="parquet",
-        choices=["jsonl", "parquet"],
-        help="Input format.",
+        choices=["jsonl", "parquet", "idx"],
+        help='Input format. "idx" is for the output of Megatron-LM format.',
+    )
+    parser.add_argument(
+        "--output_file",
+        type=str,
+        default=None,
+        help="Path to the JSON file of the counts (printed by default).",
     )
     parser.add_argument(
         "--num_proc",
@@ -38,33 +105,48 @@ def main() -> None:
         list_input_files(args.input_path, args.input_format)
     )
 
-    token_counts: dict[str, int] = {}
-    example_count: int = 0
-    for input_file in tqdm(input_files):
-        logger.info(f"Loading dataset from {input_file}.")
-        if args.input_format == "jsonl":
-            dataset = Dataset.from_json(str(input_file), keep_in_memory=True)
-        else:
-            assert args.input_format == "parquet"
-            dataset = Dataset.from_parquet(str(input_file), keep_in_memory=True)
-        logger.info(f"Counting tokens in {input_file.stem}.")
-        if "num_tokens" not in dataset.column_names:
-            dataset = dataset.map(
-                lambda example: {
-                    "num_tokens": len(example["tokens"]),
-                },
-                batched=False,
-                keep_in_memory=True,
-                num_proc=os.cpu_count() if args.num_proc == -1 else args.num_proc,
+    num_proc = os.cpu_count() if args.num_proc == -1 else args.num_proc
+    with Pool(num_proc) as pool:
+        shards: list[dict[str, Any]] = list(
+            tqdm(
+                pool.imap(
+                    functools.partial(
+                        count_file_tokens, input_format=args.input_format
+                    ),
+                    input_files,
+                ),
+                total=len(input_files),
             )
-            dataset.to_parquet(input_file)
-        token_count = sum(dataset["num_tokens"])
-        logger.info(f"{input_file.stem} has {token_count:,} tokens.")
-        token_counts[input_file.stem] = token_count
-        example_count += len(dataset)
-    logger.info(f"Total number of shards: {len(token_counts):,}.")
-    logger.info(f"Total number of examples: {example_count:,}.")
-    logger.info(f"Total number of tokens: {sum(token_counts.values()):,}.")
+        )
+
+    splits: dict[str, dict[str, int]] = {}
+    for shard in shards:
+        split = splits.setdefault(
+            shard["split"], {"num_shards": 0, "num_examples": 0, "num_tokens": 0}
+        )
+        split["num_shards"] += 1
+        split["num_examples"] += shard["num_examples"]
+        split["num_tokens"] += shard["num_tokens"]
+    total = {
+        "num_shards": len(shards),
+        "num_examples": sum(shard["num_examples"] for shard in shards),
+        "num_tokens": sum(shard["num_tokens"] for shard in shards),
+    }
+    for name, split in splits.items():
+        logger.info(
+            f"{name} has {split['num_tokens']:,} tokens in {split['num_examples']:,} "
+            f"examples of {split['num_shards']:,} shards."
+        )
+    logger.info(f"Total number of shards: {total['num_shards']:,}.")
+    logger.info(f"Total number of examples: {total['num_examples']:,}.")
+    logger.info(f"Total number of tokens: {total['num_tokens']:,}.")
+
+    counts = {"shards": shards, "splits": splits, "total": total}
+    if args.output_file is not None:
+        with open(args.output_file, "w") as f:
+            json.dump(counts, f, indent=2)
+    else:
+        print(json.dumps(counts, indent=2))
 
 
 if __name__ == "__main__":
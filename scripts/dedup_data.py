@@ -0,0 +1,503 @@
+import json
+import logging
+import multiprocessing
+import os
+import pathlib
+import tempfile
+import time
+from argparse import ArgumentParser
+from typing import Any, Optional
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as pds
+import pyarrow.parquet as pq
+from extract_ids import DATASET_NAME_TO_KEY, get_example_id
+from parquet_writer import get_temporary_file
+from utils import list_input_files
+
+logger = logging.getLogger(__name__)
+
+# Number of examples read from a parquet file at a time
+BATCH_SIZE = 10_000
+# Number of shingles hashed by all the permutations at a time, which uses a buffer of
+# `num_perm` * 8 bytes per shingle
+SHINGLE_CHUNK_SIZE = 2**14
+# Number of labels updated at a time when finding the clusters
+LABEL_CHUNK_SIZE = 2**24
+# Bases of the polynomial hashes of the shingles and of the bands of a signature
+SHINGLE_HASH_BASE = np.uint64(0x100000001B3)
+BAND_HASH_BASES = (np.uint64(0x9E3779B97F4A7C15), np.uint64(0xC2B2AE3D27D4EB4F))
+LOWER_32_BITS = np.uint64(2**32 - 1)
+SHIFT_32 = np.uint64(32)
+
+
+def get_exact_keys(texts: list[str]) -> np.ndarray:
+    """Returns the first 128 bits of the hash `extract_ids.get_example_id` gives to each
+    text as two 64-bit integers, so that exact duplicates share the ID in ID files."""
+    digests = b"".join(
+        bytes.fromhex(get_example_id({"text": text}, "hash"))[:16] for text in texts
+    )
+    return np.frombuffer(digests, dtype=np.uint64).reshape(-1, 2)
+
+
+def get_shingle_hashes(text: str, ngram_size: int) -> np.ndarray:
+    """Returns 32-bit hashes of the character n-grams of `text`, or of the whole text if
+    it is shorter than `ngram_size`."""
+    codes = np.frombuffer(
+        text.encode("utf-32-le", errors="surrogatepass"), dtype=np.uint32
+    ).astype(np.uint64)
+    num_shingles = max(len(codes) - ngram_size + 1, 1)
+    hashes = np.zeros(num_shingles, dtype=np.uint64)
+    for i in range(min(ngram_size, len(codes))):
+        hashes = hashes * SHINGLE_HASH_BASE + codes[i : i + num_shingles]
+    return (hashes >> SHIFT_32) ^ (hashes & LOWER_32_BITS)
+
+
+def get_minhash_signatures(
+    shingle_hashes: list[np.ndarray], a: np.ndarray, b: np.ndarray
+) -> np.ndarray:
+    """Returns the MinHash signatures of the examples, one row per example, under the
+    permutations `((a * x + b) mod 2^64) >> 32` of the 32-bit shingle hashes `x`.
+
+    The shingles of all the examples are concatenated and hashed by all the permutations
+    in chunks of `SHINGLE_CHUNK_SIZE` in a reused buffer, and the minimum of each example
+    in a chunk is taken by `np.minimum.reduceat`. The shift is applied to the minimums,
+    as it keeps the order.
+    """
+    signatures = np.full(
+        (len(a), len(shingle_hashes)), np.iinfo(np.uint64).max, dtype=np.uint64
+    )
+    if not shingle_hashes:
+        return signatures.T.astype(np.uint32)
+    # Every example has at least one shingle, so the starts are strictly increasing.
+    lengths = np.array([len(hashes) for hashes in shingle_hashes])
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    hashes = np.concatenate(shingle_hashes)
+    buffer = np.empty((len(a), min(len(hashes), SHINGLE_CHUNK_SIZE)), dtype=np.uint64)
+    for chunk_start in range(0, len(hashes), SHINGLE_CHUNK_SIZE):
+        chunk = hashes[chunk_start : chunk_start + SHINGLE_CHUNK_SIZE]
+        # The examples overlapping the chunk and where each of them starts in it
+        first = np.searchsorted(starts, chunk_start, side="right") - 1
+        last = np.searchsorted(starts, chunk_start + len(chunk), side="left")
+        segment_starts = np.maximum(starts[first:last] - chunk_start, 0)
+        permuted = buffer[:, : len(chunk)]
+        np.multiply(a[:, None], chunk[None, :], out=permuted)
+        permuted += b[:, None]
+        minimums = np.minimum.reduceat(permuted, segment_starts, axis=1)
+        np.minimum(signatures[:, first:last], minimums, out=signatures[:, first:last])
+    return (signatures >> SHIFT_32).T.astype(np.uint32)
+
+
+def get_band_keys(signatures: np.ndarray, num_bands: int) -> np.ndarray:
+    """Returns a 128-bit hash of each band of the signatures as two 64-bit integers, in
+    the shape of (`num_bands`, number of examples, 2)."""
+    num_examples, num_perm = signatures.shape
+    rows = num_perm // num_bands
+    bands = (
+        signatures[:, : num_bands * rows]
+        .reshape(num_examples, num_bands, rows)
+        .astype(np.uint64)
+    )
+    keys = np.empty((num_bands, num_examples, 2), dtype=np.uint64)
+    for k, base in enumerate(BAND_HASH_BASES):
+        hashes = np.zeros((num_examples, num_bands), dtype=np.uint64)
+        for row in range(rows):
+            hashes = hashes * base + bands[:, :, row]
+        keys[:, :, k] = hashes.T
+    return keys
+
+
+def hash_file(
+    input_file: pathlib.Path,
+    file_index: int,
+    offset: int,
+    work_dir: pathlib.Path,
+    options: dict[str, Any],
+) -> None:
+    """Writes the keys of the examples of `input_file` to the band index in `work_dir`.
+
+    For each band (the exact hash first, then the bands of the MinHash signature), the
+    keys and the global indices of the examples (from `offset`) are grouped by the
+    partition of the key, which is `key mod num_partitions`. They are written to
+    `{file_index}_records.npy` in the shape of (number of bands, number of examples, 3)
+    with where each partition starts in `{file_index}_offsets.npy`.
+    """
+    keys: list[np.ndarray] = []
+    parquet_file = pq.ParquetFile(input_file)
+    for batch in parquet_file.iter_batches(batch_size=BATCH_SIZE, columns=["text"]):
+        texts: list[str] = batch.column(0).to_pylist()
+        batch_keys = [get_exact_keys(texts)[None]]
+        if not options["exact_only"]:
+            shingle_hashes = [
+                get_shingle_hashes(text, options["ngram_size"]) for text in texts
+            ]
+            signatures = get_minhash_signatures(
+                shingle_hashes, options["a"], options["b"]
+            )
+            batch_keys.append(get_band_keys(signatures, options["num_bands"]))
+        keys.append(np.concatenate(batch_keys))
+    num_keys = 1 if options["exact_only"] else 1 + options["num_bands"]
+    num_examples = parquet_file.metadata.num_rows
+    all_keys = (
+        np.concatenate(keys, axis=1)
+        if keys
+        else np.empty((num_keys, 0, 2), dtype=np.uint64)
+    )
+    indices = np.arange(offset, offset + num_examples, dtype=np.uint64)
+    num_partitions = options["num_partitions"]
+    records = np.empty((num_keys, num_examples, 3), dtype=np.uint64)
+    offsets = np.empty((num_keys, num_partitions + 1), dtype=np.int64)
+    for band in range(num_keys):
+        partitions = all_keys[band, :, 0] % np.uint64(num_partitions)
+        order = np.argsort(partitions, kind="stable")
+        records[band, :, :2] = all_keys[band, order]
+        records[band, :, 2] = indices[order]
+        offsets[band] = np.searchsorted(
+            partitions[order], np.arange(num_partitions + 1, dtype=np.uint64)
+        )
+    np.save(work_dir.joinpath(f"{file_index}_records.npy"), records)
+    np.save(work_dir.joinpath(f"{file_index}_offsets.npy"), offsets)
+
+
+def find_duplicate_pairs(
+    work_dir: pathlib.Path, num_files: int, band: int, partition: int
+) -> int:
+    """Finds the examples with the same key in a partition of a band, and writes the
+    pairs of each of them and the first example with the key to
+    `pairs_{band}_{partition}.npy`. Returns the number of pairs."""
+    chunks: list[np.ndarray] = []
+    for file_index in range(num_files):
+        offsets = np.load(work_dir.joinpath(f"{file_index}_offsets.npy"))
+        records = np.load(work_dir.joinpath(f"{file_index}_records.npy"), mmap_mode="r")
+        start, end = offsets[band, partition], offsets[band, partition + 1]
+        chunks.append(np.asarray(records[band, start:end]))
+    records = np.concatenate(chunks)
+    records = records[np.lexsort((records[:, 2], records[:, 1], records[:, 0]))]
+    is_first = np.ones(len(records), dtype=bool)
+    is_first[1:] = (records[1:, 0] != records[:-1, 0]) | (
+        records[1:, 1] != records[:-1, 1]
+    )
+    first = np.maximum.accumulate(np.where(is_first, np.arange(len(records)), 0))
+    pairs = np.stack([records[first, 2], records[:, 2]], axis=1)[~is_first]
+    np.save(work_dir.joinpath(f"pairs_{band}_{partition}.npy"), pairs)
+    return len(pairs)
+
+
+def get_cluster_labels(
+    pair_files: list[pathlib.Path], num_examples: int, labels_file: pathlib.Path
+) -> np.ndarray:
+    """Labels each example with the smallest index of the examples connected to it by the
+    pairs, which is the example kept from its cluster.
+
+    The labels are a memory-mapped file. They are propagated along the pairs by
+    `np.minimum.at` and shortcut to the label of the label until nothing changes.
+    """
+    labels = np.lib.format.open_memmap(
+        labels_file, mode="w+", dtype=np.int64, shape=(num_examples,)
+    )
+    for start in range(0, num_examples, LABEL_CHUNK_SIZE):
+        end = min(start + LABEL_CHUNK_SIZE, num_examples)
+        labels[start:end] = np.arange(start, end)
+    num_iterations = 0
+    changed = True
+    while changed:
+        changed = False
+        num_iterations += 1
+        for pair_file in pair_files:
+            pairs = np.load(pair_file).astype(np.int64)
+            if len(pairs) == 0:
+                continue
+            left, right = labels[pairs[:, 0]], labels[pairs[:, 1]]
+            if not (left != right).any():
+                continue
+            changed = True
+            minimums = np.minimum(left, right)
+            np.minimum.at(labels, pairs[:, 0], minimums)
+            np.minimum.at(labels, pairs[:, 1], minimums)
+        jumped = True
+        while jumped:
+            jumped = False
+            for start in range(0, num_examples, LABEL_CHUNK_SIZE):
+                chunk = np.asarray(labels[start : start + LABEL_CHUNK_SIZE])
+                parents = labels[chunk]
+                if (parents != chunk).any():
+                    jumped = True
+                    labels[start : start + LABEL_CHUNK_SIZE] = parents
+    logger.info(f"Found the clusters in {num_iterations} iterations.")
+    labels.flush()
+    return labels
+
+
+def mark_duplicates(
+    labels: np.ndarray, num_examples: int, duplicates_file: pathlib.Path
+) -> None:
+    """Marks the examples in a cluster of more than one example, whether kept or not,
+    in a memory-mapped file."""
+    is_duplicate = np.lib.format.open_memmap(
+        duplicates_file, mode="w+", dtype=bool, shape=(num_examples,)
+    )
+    for start in range(0, num_examples, LABEL_CHUNK_SIZE):
+        chunk = np.asarray(labels[start : start + LABEL_CHUNK_SIZE])
+        removed = chunk != np.arange(start, start + len(chunk))
+        is_duplicate[start : start + len(chunk)] |= removed
+        is_duplicate[chunk[removed]] = True
+    is_duplicate.flush()
+
+
+def write_file(
+    input_file: pathlib.Path,
+    file_index: int,
+    offset: int,
+    output_file: pathlib.Path,
+    work_dir: pathlib.Path,
+    id_key: Optional[str],
+    overwrite: bool,
+) -> tuple[int, int]:
+    """Writes the examples of `input_file` kept from their clusters to `output_file`,
+    and the members of the clusters of more than one example to
+    `{file_index}_members.parquet`. Returns the numbers of input and output examples."""
+    table = pq.read_table(input_file)
+    end = offset + table.num_rows
+    labels = np.load(work_dir.joinpath("labels.npy"), mmap_mode="r")[offset:end]
+    is_duplicate = np.load(work_dir.joinpath("duplicates.npy"), mmap_mode="r")
+    indices = np.arange(offset, end)
+    keep = labels == indices
+    if output_file.exists() and not overwrite:
+        logger.error(f"{output_file} already exists. Specify --overwrite to overwrite.")
+    else:
+        temporary_file = get_temporary_file(output_file)
+        pq.write_table(table.filter(keep), temporary_file)
+        os.replace(temporary_file, output_file)
+    is_member = np.asarray(is_duplicate[offset:end])
+    examples = table.filter(is_member).to_pylist()
+    members = pa.table(
+        {
+            "cluster": labels[is_member],
+            "index": indices[is_member],
+            "id": [get_example_id(example, id_key) for example in examples],
+            "hash": [get_example_id(example, "hash") for example in examples],
+        }
+    )
+    pq.write_table(members, work_dir.joinpath(f"{file_index}_members.parquet"))
+    return table.num_rows, int(keep.sum())
+
+
+def write_clusters(work_dir: pathlib.Path, output_file: pathlib.Path) -> dict[str, int]:
+    """Writes each cluster of duplicates as a JSON line with the ID of the kept example
+    and those of the removed ones, which are exact duplicates if they have the same
+    hash. Returns the numbers of clusters and removed examples."""
+    members = pds.dataset(
+        sorted(work_dir.glob("*_members.parquet")), format="parquet"
+    ).to_table()
+    members = members.sort_by([("cluster", "ascending"), ("index", "ascending")])
+    stats = {"num_clusters": 0, "num_exact_duplicates": 0, "num_near_duplicates": 0}
+    with output_file.open("w") as f:
+        cluster: dict[str, Any] = {}
+        kept_hash = ""
+        for member in members.to_pylist():
+            if member["cluster"] == member["index"]:
+                if cluster:
+                    f.write(json.dumps(cluster, ensure_ascii=False) + "\n")
+                cluster = {"kept": member["id"], "exact": [], "near": []}
+                kept_hash = member["hash"]
+                stats["num_clusters"] += 1
+            elif member["hash"] == kept_hash:
+                cluster["exact"].append(member["id"])
+                stats["num_exact_duplicates"] += 1
+            else:
+                cluster["near"].append(member["id"])
+                stats["num_near_duplicates"] += 1
+        if cluster:
+            f.write(json.dumps(cluster, ensure_ascii=False) + "\n")
+    return stats
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument(
+        "DATASET_NAME",
+        type=str,
+        choices=["ja_wiki", "en_wiki", "ja_cc", "en_pile", "code_stack"],
+        help="Dataset name, which decides the IDs in the report.",
+    )
+    parser.add_argument(
+        "--input_path",
+        type=str,
+        nargs="+",
+        help="Path(s) to the input data directory or file.",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        help="Path to the output directory.",
+    )
+    parser.add_argument(
+        "--work_dir",
+        type=str,
+        default=None,
+        help="Path to the directory of the band index, which takes about "
+        "24 * (num_bands + 1) bytes per example (the output directory by default). "
+        "The index is written to a new subdirectory of it, which is removed at exit.",
+    )
+    parser.add_argument(
+        "--exact_only",
+        action="store_true",
+        help="Whether to remove only the exact duplicates.",
+    )
+    parser.add_argument(
+        "--num_perm",
+        type=int,
+        default=128,
+        help="Number of permutations of MinHash.",
+    )
+    parser.add_argument(
+        "--num_bands",
+        type=int,
+        default=16,
+        help="Number of bands of LSH. Examples with a Jaccard similarity over about "
+        "(1 / num_bands) ^ (num_bands / num_perm) are likely to be duplicates.",
+    )
+    parser.add_argument(
+        "--ngram_size",
+        type=int,
+        default=5,
+        help="Number of characters of a shingle.",
+    )
+    parser.add_argument(
+        "--num_partitions",
+        type=int,
+        default=16,
+        help="Number of partitions of each band, which are deduplicated one by one.",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed of the permutations.",
+    )
+    parser.add_argument(
+        "--num_proc",
+        type=int,
+        default=-1,
+        help="Number of processes for parallel execution.",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Whether to overwrite the output directory.",
+    )
+    args = parser.parse_args()
+    if args.num_perm % args.num_bands != 0:
+        parser.error("--num_perm must be a multiple of --num_bands.")
+
+    output_dir = pathlib.Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    num_proc = os.cpu_count() if args.num_proc == -1 else args.num_proc
+
+    start_time = time.time()
+
+    input_files: list[pathlib.Path] = sorted(
+        list_input_files(args.input_path, "parquet")
+    )
+    if not input_files:
+        return
+    num_rows = [pq.read_metadata(input_file).num_rows for input_file in input_files]
+    offsets = np.concatenate([[0], np.cumsum(num_rows)]).tolist()
+    num_examples = offsets[-1]
+
+    rng = np.random.default_rng(args.seed)
+    options = {
+        "exact_only": args.exact_only,
+        "num_bands": args.num_bands,
+        "ngram_size": args.ngram_size,
+        "num_partitions": args.num_partitions,
+        # Odd multipliers and offsets of the permutations
+        "a": rng.integers(0, 2**64, size=args.num_perm, dtype=np.uint64)
+        | np.uint64(1),
+        "b": rng.integers(0, 2**64, size=args.num_perm, dtype=np.uint64),
+    }
+    num_keys = 1 if args.exact_only else 1 + args.num_bands
+
+    # A new directory of this run, so that nothing else is removed with it. It is
+    # removed whether or not the run succeeds.
+    parent_work_dir = pathlib.Path(args.work_dir) if args.work_dir else output_dir
+    parent_work_dir.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(
+        prefix="dedup_work_", dir=parent_work_dir
+    ) as work_dir_name:
+        work_dir = pathlib.Path(work_dir_name)
+        with multiprocessing.get_context("fork").Pool(num_proc) as pool:
+            logger.info(
+                f"Hashing {num_examples:,} examples in {len(input_files)} files."
+            )
+            pool.starmap(
+                hash_file,
+                [
+                    (input_file, file_index, offsets[file_index], work_dir, options)
+                    for file_index, input_file in enumerate(input_files)
+                ],
+                chunksize=1,
+            )
+
+            logger.info("Finding the examples with the same key in each band.")
+            units = [
+                (work_dir, len(input_files), band, partition)
+                for band in range(num_keys)
+                for partition in range(args.num_partitions)
+            ]
+            num_pairs = sum(pool.starmap(find_duplicate_pairs, units, chunksize=1))
+            logger.info(f"Found {num_pairs:,} pairs of duplicates.")
+
+            labels = get_cluster_labels(
+                sorted(work_dir.glob("pairs_*.npy")),
+                num_examples,
+                work_dir.joinpath("labels.npy"),
+            )
+            mark_duplicates(labels, num_examples, work_dir.joinpath("duplicates.npy"))
+
+            logger.info(f"Writing the deduplicated data to {output_dir}.")
+            counts = pool.starmap(
+                write_file,
+                [
+                    (
+                        input_file,
+                        file_index,
+                        offsets[file_index],
+                        output_dir.joinpath(input_file.name),
+                        work_dir,
+                        DATASET_NAME_TO_KEY[args.DATASET_NAME],
+                        args.overwrite,
+                    )
+                    for file_index, input_file in enumerate(input_files)
+                ],
+                chunksize=1,
+            )
+
+        report = {
+            "num_input": sum(num_input for num_input, _ in counts),
+            "num_output": sum(num_output for _, num_output in counts),
+            **write_clusters(work_dir, output_dir.joinpath("duplicate_clusters.jsonl")),
+        }
+        output_dir.joinpath("dedup_report.json").write_text(
+            json.dumps(report, indent=2)
+        )
+        logger.info(
+            f"Removed {report['num_input'] - report['num_output']:,} of "
+            f"{report['num_input']:,} examples ({report['num_exact_duplicates']:,} exact "
+            f"and {report['num_near_duplicates']:,} near duplicates)."
+        )
+
+    end_time = time.time()
+    logger.info(
+        f"Finished deduplicating the dataset. Elapsed time: {end_time - start_time} "
+        "[sec]"
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format="%(asctime)s %(name)s:%(lineno)d: %(levelname)s: %(message)s",
+    )
+    main()
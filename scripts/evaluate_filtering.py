@@ -73,12 +73,13 @@ def main() -> None:
 
     logger.info("Loading the dataset")
     dataset: DatasetDict = load_dataset("json", data_files=args.input_path)
-    filtered_dataset = reformat_and_filter_dataset(
+    filtered_dataset, pipelines = reformat_and_filter_dataset(
         dataset, args.DATASET_NAME, strict=args.strict
     )
 
     assert "train" in dataset.keys() and "train" in filtered_dataset.keys()
     stats = get_stats(dataset["train"], filtered_dataset["train"])
+    pipelines["train"].log_stats()
 
     print(f"- Precision: {stats['precision']:.3f}")
     print(f"- Recall: {stats['recall']:.3f}")
@@ -1,16 +1,23 @@
+import functools
 import hashlib
 import json
 import logging
+import os
 import pathlib
+import struct
 from argparse import ArgumentParser
+from collections.abc import Iterable, Iterator
+from multiprocessing import Pool
 from typing import Any, Optional
 
-from datasets import Dataset, disable_caching
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from parquet_writer import get_temporary_file
 from tqdm import tqdm
-from utils import list_input_files
+from utils import list_input_files, read_jsonl_blocks
 
 logger = logging.getLogger(__name__)
-disable_caching()
 
 DATASET_NAME_TO_KEY: dict[str, Optional[str]] = {
     "ja_wiki": "id",
@@ -19,6 +26,15 @@ DATASET_NAME_TO_KEY: dict[str, Optional[str]] = {
     "en_pile": None,
     "code_stack": "hexsha",
 }
+# Size [bytes] of the digests of the IDs, e.g., the first 128 bits of the SHA-256 of
+# the text. The probability of a collision is negligible for billions of examples.
+ID_DIGEST_SIZE = 16
+ID_DIGEST_DTYPE = np.dtype(f"S{ID_DIGEST_SIZE}")
+# The header of the binary ID files
+ID_FILE_MAGIC = b"LLMJPIDS"
+ID_FILE_VERSION = 1
+# Size [bytes] of a block of the JSONL input parsed at a time
+BLOCK_SIZE = 16 * 2**20
 
 
 def get_example_id(example: dict[str, Any], id_key: Optional[str]) -> str:
@@ -28,6 +44,165 @@ def get_example_id(example: dict[str, Any], id_key: Optional[str]) -> str:
         return example["meta"][id_key]
 
 
+def iter_text_bytes(texts: pa.ChunkedArray) -> Iterator[memoryview]:
+    """Yields the UTF-8 bytes of each text in the Arrow buffers of a string column,
+    which saves decoding them to `str` just to encode them again."""
+    for chunk in texts.chunks:
+        offset_dtype = np.int64 if pa.types.is_large_string(chunk.type) else np.int32
+        _, offset_buffer, data_buffer = chunk.buffers()
+        offsets = np.frombuffer(offset_buffer, dtype=offset_dtype)
+        offsets = offsets[chunk.offset : chunk.offset + len(chunk) + 1].tolist()
+        data = memoryview(data_buffer if data_buffer is not None else b"")
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            yield data[start:end]
+
+
+def get_example_ids(table: pa.Table, id_key: Optional[str]) -> pa.ChunkedArray:
+    """Returns the IDs of the examples of a table as `get_example_id` does, without
+    converting the other columns to Python objects."""
+    if id_key is not None and id_key != "hash":
+        meta_type = table.schema.field("meta").type
+        index = meta_type.get_field_index(id_key)
+        return pa.chunked_array(
+            [chunk.flatten()[index] for chunk in table["meta"].chunks],
+            type=meta_type[index].type,
+        )
+    return pa.chunked_array(
+        [
+            pa.array(
+                [
+                    hashlib.sha256(text).hexdigest()
+                    for text in iter_text_bytes(table["text"])
+                ],
+                type=pa.string(),
+            )
+        ]
+    )
+
+
+def get_id_digest(id_: Any, id_key: Optional[str]) -> bytes:
+    """Returns the first `ID_DIGEST_SIZE` bytes of the SHA-256 of an ID, which is the
+    ID itself for the hash of the text."""
+    if id_key is None or id_key == "hash":
+        return bytes.fromhex(id_)[:ID_DIGEST_SIZE]
+    return hashlib.sha256(str(id_).encode()).digest()[:ID_DIGEST_SIZE]
+
+
+def get_example_digests(table: pa.Table, id_key: Optional[str]) -> np.ndarray:
+    """Returns the digests of the IDs of the examples of a table as `get_id_digest`
+    gives them for the IDs of `get_example_ids`."""
+    if id_key is None or id_key == "hash":
+        digests = b"".join(
+            hashlib.sha256(text).digest()[:ID_DIGEST_SIZE]
+            for text in iter_text_bytes(table["text"])
+        )
+    else:
+        digests = b"".join(
+            get_id_digest(id_, id_key)
+            for id_ in get_example_ids(table, id_key).to_pylist()
+        )
+    return np.frombuffer(digests, dtype=ID_DIGEST_DTYPE)
+
+
+def get_id_index(ids: Iterable[Any], id_key: Optional[str]) -> np.ndarray:
+    """Returns the sorted unique digests of IDs, which take `ID_DIGEST_SIZE` bytes per
+    ID instead of a Python `str` of 64 characters (about 110 bytes) in a `set`."""
+    digests = b"".join(get_id_digest(id_, id_key) for id_ in ids)
+    return np.unique(np.frombuffer(digests, dtype=ID_DIGEST_DTYPE))
+
+
+def is_in_id_index(digests: np.ndarray, id_index: np.ndarray) -> np.ndarray:
+    """Returns whether each digest is in an index of `get_id_index` by a binary
+    search."""
+    if len(id_index) == 0:
+        return np.zeros(len(digests), dtype=bool)
+    positions = np.searchsorted(id_index, digests)
+    positions[positions == len(id_index)] = 0
+    return id_index[positions] == digests
+
+
+def write_id_file(
+    output_file: pathlib.Path, id_key: Optional[str], id_index: np.ndarray
+) -> None:
+    """Writes an index of `get_id_index` to a binary ID file: `ID_FILE_MAGIC`, the
+    version, the size of the digests, the number of IDs, and the length of the key
+    (8 bytes each), the key, and the sorted digests. It is written under a temporary
+    name and renamed once complete."""
+    key = (id_key or "hash").encode()
+    temporary_file = get_temporary_file(output_file)
+    with temporary_file.open("wb") as f:
+        f.write(ID_FILE_MAGIC)
+        f.write(
+            struct.pack(
+                "<QQQQ", ID_FILE_VERSION, ID_DIGEST_SIZE, len(id_index), len(key)
+            )
+        )
+        f.write(key)
+        f.write(np.ascontiguousarray(id_index, dtype=ID_DIGEST_DTYPE).tobytes())
+    os.replace(temporary_file, output_file)
+
+
+def read_id_file(input_file: pathlib.Path) -> tuple[str, np.ndarray]:
+    """Reads an ID file, either binary or JSON (`{"key": ..., "ids": [...]}`). Returns
+    the key and the sorted digests of the IDs as `get_id_index` gives them, which are
+    memory-mapped from a binary file."""
+    with input_file.open("rb") as f:
+        if f.read(len(ID_FILE_MAGIC)) != ID_FILE_MAGIC:
+            id_data: dict[str, Any] = json.loads(input_file.read_text())
+            return id_data["key"], get_id_index(id_data["ids"], id_data["key"])
+        version, digest_size, num_ids, key_size = struct.unpack("<QQQQ", f.read(32))
+        if version != ID_FILE_VERSION:
+            raise ValueError(f"The version {version} of {input_file} is unsupported.")
+        if digest_size != ID_DIGEST_SIZE:
+            raise ValueError(f"{input_file} has digests of {digest_size} bytes.")
+        key = f.read(key_size).decode()
+        offset = f.tell()
+    if num_ids == 0:
+        # An empty range cannot be memory-mapped.
+        return key, np.zeros(0, dtype=ID_DIGEST_DTYPE)
+    return key, np.memmap(
+        input_file, dtype=ID_DIGEST_DTYPE, mode="r", offset=offset, shape=(num_ids,)
+    )
+
+
+def iter_id_tables(
+    input_file: pathlib.Path, input_format: str, id_key: Optional[str]
+) -> Iterator[pa.Table]:
+    """Yields the column the IDs are computed from (`text` or `meta`) in tables of a
+    row group of parquet or a block of JSONL."""
+    column = "text" if id_key is None or id_key == "hash" else "meta"
+    if input_format == "jsonl":
+        file_size = input_file.stat().st_size
+        for table, _ in read_jsonl_blocks(input_file, 0, file_size, BLOCK_SIZE):
+            yield table.select([column])
+    else:
+        assert input_format == "parquet"
+        parquet_file = pq.ParquetFile(input_file)
+        for index in range(parquet_file.num_row_groups):
+            yield parquet_file.read_row_group(index, columns=[column])
+
+
+def extract_file_ids(
+    input_file: pathlib.Path, input_format: str, id_key: Optional[str]
+) -> list[Any]:
+    """Returns the IDs of the examples of a file in order."""
+    ids_: list[Any] = []
+    for table in iter_id_tables(input_file, input_format, id_key):
+        ids_ += get_example_ids(table, id_key).to_pylist()
+    return ids_
+
+
+def extract_file_digests(
+    input_file: pathlib.Path, input_format: str, id_key: Optional[str]
+) -> np.ndarray:
+    """Returns the sorted unique digests of the IDs of the examples of a file."""
+    digests = [
+        get_example_digests(table, id_key)
+        for table in iter_id_tables(input_file, input_format, id_key)
+    ]
+    return np.unique(np.concatenate(digests or [np.zeros(0, dtype=ID_DIGEST_DTYPE)]))
+
+
 def main() -> None:
     parser = ArgumentParser()
     parser.add_argument(
@@ -54,6 +229,16 @@ def main() -> None:
         type=str,
         help="Path to the output file.",
     )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        default="binary",
+        choices=["binary", "json"],
+        help=(
+            'Output format. "binary" writes the sorted unique digests of the IDs, which '
+            "split_data_by_id.py memory-maps."
+        ),
+    )
     parser.add_argument(
         "--num_proc",
         type=int,
@@ -67,20 +252,45 @@ def main() -> None:
     )
     key = DATASET_NAME_TO_KEY[args.DATASET_NAME]
 
-    ids_: list[str] = []
-    for input_file in tqdm(input_files):
-        logger.info(f"Loading dataset from {input_file}.")
-        if args.input_format == "jsonl":
-            dataset = Dataset.from_json(str(input_file), keep_in_memory=True)
+    num_proc = os.cpu_count() if args.num_proc == -1 else args.num_proc
+    output_file = pathlib.Path(args.output_file)
+    with Pool(num_proc) as pool:
+        if args.output_format == "json":
+            ids_: list[Any] = []
+            for file_ids in tqdm(
+                pool.imap(
+                    functools.partial(
+                        extract_file_ids, input_format=args.input_format, id_key=key
+                    ),
+                    input_files,
+                ),
+                total=len(input_files),
+            ):
+                ids_ += file_ids
+            logger.info(f"Extracted {len(ids_):,} IDs.")
+            output_file.write_text(
+                json.dumps({"key": key or "hash", "ids": ids_}, indent=2)
+            )
         else:
-            assert args.input_format == "parquet"
-            dataset = Dataset.from_parquet(str(input_file), keep_in_memory=True)
-        logger.info(f"Extracting keys in {input_file.name}.")
-        for example in dataset:
-            ids_.append(get_example_id(example, key))
-    pathlib.Path(args.output_file).write_text(
-        json.dumps({"key": key or "hash", "ids": ids_}, indent=2)
-    )
+            assert args.output_format == "binary"
+            digests = list(
+                tqdm(
+                    pool.imap_unordered(
+                        functools.partial(
+                            extract_file_digests,
+                            input_format=args.input_format,
+                            id_key=key,
+                        ),
+                        input_files,
+                    ),
+                    total=len(input_files),
+                )
+            )
+            id_index = np.unique(
+                np.concatenate(digests or [np.zeros(0, dtype=ID_DIGEST_DTYPE)])
+            )
+            logger.info(f"Extracted {len(id_index):,} unique IDs.")
+            write_id_file(output_file, key, id_index)
 
 
 if __name__ == "__main__":
@@ -1,10 +1,18 @@
+import collections
+import csv
+import json
 import logging
+import math
+import multiprocessing
 import pathlib
 import time
 import typing
 from argparse import ArgumentParser
-from typing import Any, Callable
+from typing import Any, Callable, Optional
 
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import tqdm
 from datasets import (
     Dataset,
@@ -15,29 +23,47 @@ from datasets import (
 )
 from datasets.splits import Split
 from filters import (
+    NG_WORDS_CATEGORIES,
+    QUALITY_SIGNAL_COLUMNS,
+    add_quality_signals,
+    clean_wikipedia_text,
+    count_domains,
     extract_japanese_text,
     has_good_average_sentence_length,
     has_good_compression_ratio,
     has_valid_alphanum_fraction,
+    has_valid_alphanum_fraction_expression,
     has_valid_avg_line_length,
+    has_valid_avg_line_length_expression,
     has_valid_domain,
     has_valid_extension,
+    has_valid_extension_expression,
     has_valid_max_line_length,
+    has_valid_max_line_length_expression,
+    has_valid_pile_set_name,
+    has_valid_pile_set_name_expression,
     is_japanese,
     is_not_ad_content,
-    is_not_adult_content,
-    is_not_discrimination_content,
     is_not_empty,
-    is_not_violence_content,
+    is_not_harmful_content,
     reformat_data,
-    remove_empty_parenthesis,
-    remove_wikipedia_footnote,
 )
+from parquet_writer import ParquetShardWriter, read_manifest
+from pipeline import FilterPipeline, Stage, get_stage_name
+from utils import read_jsonl_blocks
 
 logger = logging.getLogger(__name__)
 disable_caching()
 
 CHUNK_SIZE = 100_000
+BATCH_SIZE = 1_000
+# Number of examples per batch of the vectorized filters
+ARROW_BATCH_SIZE = 10_000
+# Maximum size [bytes] of a shard of the input filtered by a worker process
+SHARD_SIZE = 256 * 2**20
+# Size [bytes] of a block of the JSONL input parsed at a time, which is the unit of
+# resuming an interrupted run
+BLOCK_SIZE = 16 * 2**20
 
 
 def get_data_files(search_dir: pathlib.Path, ext: str) -> dict[Split, pathlib.Path]:
@@ -55,21 +81,57 @@ def get_data_files(search_dir: pathlib.Path, ext: str) -> dict[Split, pathlib.Pa
     return data_files
 
 
-def reformat_and_filter_dataset(
-    dataset: DatasetDict, dataset_name: str, strict: bool = False
-) -> DatasetDict:
+# The thresholds of numbers of words and characters
+INTEGER_THRESHOLDS = ("max_ad_words", "max_ng_words", "max_average_sentence_length")
+
+
+def get_thresholds(strict: bool = False) -> dict[str, float]:
+    """Returns the thresholds of the ja_cc filters."""
+    return {
+        "max_ad_words": 10,
+        "max_ng_words": 2 if strict else 3,
+        "max_average_sentence_length": 80 if strict else 250,
+        "min_compression_ratio": 0.375 if strict else 0.30,
+        "max_compression_ratio": 0.70,
+        "compression_length_factor": 0.0,
+    }
+
+
+def parse_thresholds(values: list[str]) -> dict[str, float]:
+    thresholds: dict[str, float] = {}
+    valid_names = get_thresholds().keys()
+    for value in values:
+        name, _, number = value.partition("=")
+        if name not in valid_names:
+            raise ValueError(f"Unknown threshold: {name}.")
+        thresholds[name] = float(number)
+        # The filters take these as integers, so a fraction would be truncated by
+        # --mode filter but not by --mode apply.
+        if name in INTEGER_THRESHOLDS and not thresholds[name].is_integer():
+            raise ValueError(f"{name} should be an integer: {number}.")
+    return thresholds
+
+
+def get_stages(
+    dataset_name: str,
+    strict: bool = False,
+    thresholds: Optional[dict[str, float]] = None,
+    include_filters: bool = True,
+    compression_options: Optional[dict[str, Any]] = None,
+    domain_counts: Optional[collections.Counter[str]] = None,
+) -> list[Stage]:
     reformat_fn: Callable[..., dict[str, Any]]
     map_fns: list[Callable[..., dict[str, Any]]] = []
     filter_fns: list[Callable[..., bool]] = []
+    # Filter name -> the filter as an expression on the input
+    expression_fns: dict[str, Callable[[pa.Schema], pc.Expression]] = {}
     if dataset_name == "ja_wiki":
         reformat_fn = reformat_data("text")
-        map_fns.append(remove_wikipedia_footnote())
-        map_fns.append(remove_empty_parenthesis())
+        map_fns.append(clean_wikipedia_text())
         filter_fns.append(is_not_empty())
     elif dataset_name == "en_wiki":
         reformat_fn = reformat_data("text")
-        map_fns.append(remove_wikipedia_footnote())
-        map_fns.append(remove_empty_parenthesis())
+        map_fns.append(clean_wikipedia_text())
         filter_fns.append(is_not_empty())
     elif dataset_name == "ja_cc":
         reformat_fn = reformat_data("text")
@@ -77,20 +139,27 @@ def reformat_and_filter_dataset(
         filter_fns.append(has_valid_domain())
         filter_fns.append(is_not_empty())
         filter_fns.append(is_japanese())
-        filter_fns.append(is_not_ad_content())
-        max_allowed_num: int = 2 if strict else 3
-        filter_fns.append(is_not_adult_content(max_allowed_num))
-        filter_fns.append(is_not_discrimination_content(max_allowed_num))
-        filter_fns.append(is_not_violence_content(max_allowed_num))
-        max_average_sentence_length: int = 80 if strict else 250
-        filter_fns.append(has_good_average_sentence_length(max_average_sentence_length))
-        min_score = 0.375 if strict else 0.30
-        max_score = 0.70
-        filter_fns.append(has_good_compression_ratio(min_score, max_score))
+        thresholds = {**get_thresholds(strict), **(thresholds or {})}
+        filter_fns.append(is_not_ad_content(int(thresholds["max_ad_words"])))
+        filter_fns.append(is_not_harmful_content(int(thresholds["max_ng_words"])))
+        filter_fns.append(
+            has_good_average_sentence_length(
+                int(thresholds["max_average_sentence_length"])
+            )
+        )
+        filter_fns.append(
+            has_good_compression_ratio(
+                thresholds["min_compression_ratio"],
+                thresholds["max_compression_ratio"],
+                thresholds["compression_length_factor"],
+                **(compression_options or {}),
+            )
+        )
     elif dataset_name == "en_pile":
         reformat_fn = reformat_data("text")
         filter_fns.append(is_not_empty())
-        filter_fns.append(lambda x: x["meta"]["pile_set_name"] != "Books3")
+        filter_fns.append(has_valid_pile_set_name())
+        expression_fns["has_valid_pile_set_name"] = has_valid_pile_set_name_expression()
     elif dataset_name == "code_stack":
         reformat_fn = reformat_data("content")
         filter_fns.append(has_valid_extension())
@@ -98,23 +167,517 @@ def reformat_and_filter_dataset(
         filter_fns.append(has_valid_avg_line_length())
         filter_fns.append(has_valid_alphanum_fraction())
         filter_fns.append(is_not_empty())
+        expression_fns["has_valid_extension"] = has_valid_extension_expression()
+        expression_fns[
+            "has_valid_max_line_length"
+        ] = has_valid_max_line_length_expression()
+        expression_fns[
+            "has_valid_avg_line_length"
+        ] = has_valid_avg_line_length_expression()
+        expression_fns[
+            "has_valid_alphanum_fraction"
+        ] = has_valid_alphanum_fraction_expression()
     else:
         raise ValueError(f"Unknown dataset name: {dataset_name}.")
 
-    dataset = dataset.map(reformat_fn, batched=False)
+    stages: list[Stage] = [Stage("map", reformat_fn, get_stage_name(reformat_fn))]
+    if domain_counts is not None:
+        # Before the filters so that every document is counted in any filter order.
+        count_fn = count_domains(domain_counts)
+        stages.append(Stage("map", count_fn, get_stage_name(count_fn)))
+    if include_filters:
+        stages += [
+            Stage(
+                "filter",
+                fn,
+                get_stage_name(fn),
+                expression=expression_fns.get(get_stage_name(fn)),
+            )
+            for fn in filter_fns
+        ]
+    stages += [Stage("map", fn, get_stage_name(fn)) for fn in map_fns]
+    final_filter_fn = is_not_empty()
+    stages.append(Stage("filter", final_filter_fn, get_stage_name(final_filter_fn)))
+    return stages
+
+
+def get_column_names(dataset: DatasetDict) -> list[str]:
     train_dataset: typing.Union[Dataset, IterableDataset] = dataset["train"]
     if isinstance(train_dataset, Dataset):
-        columns = list(train_dataset[0].keys())
+        return list(train_dataset[0].keys())
     elif isinstance(train_dataset, IterableDataset):
-        columns = list(train_dataset.take(1))[0].keys()
+        return list(list(train_dataset.take(1))[0].keys())
     else:
         raise ValueError
-    dataset = dataset.map(remove_columns=list(set(columns) - {"text", "meta"}))
-    for filter_fn in filter_fns:
-        dataset = dataset.filter(filter_fn)
-    for map_fn in map_fns:
-        dataset = dataset.map(map_fn, batched=False)
-    return dataset.filter(is_not_empty())
+
+
+def take(
+    dataset: typing.Union[Dataset, IterableDataset], num_examples: int
+) -> list[dict[str, Any]]:
+    if isinstance(dataset, Dataset):
+        return list(dataset.select(range(min(num_examples, len(dataset)))))
+    return list(dataset.take(num_examples))
+
+
+def get_pipeline(
+    dataset: typing.Union[Dataset, IterableDataset],
+    dataset_name: str,
+    strict: bool = False,
+    num_warmup_examples: int = 0,
+    profile: bool = False,
+    thresholds: Optional[dict[str, float]] = None,
+    compression_options: Optional[dict[str, Any]] = None,
+    vectorize: bool = True,
+    domain_counts: Optional[collections.Counter[str]] = None,
+) -> FilterPipeline:
+    pipeline = FilterPipeline(
+        get_stages(
+            dataset_name,
+            strict=strict,
+            thresholds=thresholds,
+            compression_options=compression_options,
+            domain_counts=domain_counts,
+        ),
+        output_columns=("text", "meta"),
+        profile=profile,
+        vectorize=vectorize,
+    )
+    if num_warmup_examples > 0:
+        logger.info("Optimizing the filter order.")
+        pipeline.optimize(take(dataset, num_warmup_examples))
+        if domain_counts is not None:
+            # The warmup examples are counted again by the pipeline.
+            domain_counts.clear()
+    return pipeline
+
+
+def reformat_and_filter_dataset(
+    dataset: DatasetDict,
+    dataset_name: str,
+    strict: bool = False,
+    num_warmup_examples: int = 0,
+    profile: bool = False,
+    thresholds: Optional[dict[str, float]] = None,
+    compression_options: Optional[dict[str, Any]] = None,
+    vectorize: bool = True,
+    parquet_files: Optional[dict[str, pathlib.Path]] = None,
+    domain_counts: Optional[dict[str, collections.Counter[str]]] = None,
+) -> tuple[DatasetDict, dict[str, FilterPipeline]]:
+    """Reformats and filters every split of `dataset`.
+
+    With `vectorize`, the filters that only read the metadata are applied to Arrow
+    batches of the input first. If `parquet_files` of the splits are given, they are
+    instead pushed down into a scan of the files, which replaces the splits.
+
+    If `domain_counts` is given, the number of input documents per hostname of the URL
+    is counted into it for each split while the dataset is iterated.
+    """
+    columns = get_column_names(dataset)
+    pipelines: dict[str, FilterPipeline] = {}
+    for split in dataset.keys():
+        if domain_counts is not None:
+            domain_counts[split] = collections.Counter()
+        pipelines[split] = get_pipeline(
+            dataset[split],
+            dataset_name,
+            strict=strict,
+            num_warmup_examples=num_warmup_examples,
+            profile=profile,
+            thresholds=thresholds,
+            compression_options=compression_options,
+            vectorize=vectorize,
+            domain_counts=domain_counts[split] if domain_counts is not None else None,
+        )
+        if pipelines[split].vectorized_stages:
+            if parquet_files is not None:
+                dataset[split] = IterableDataset.from_generator(
+                    pipelines[split].scan_parquet,
+                    gen_kwargs={
+                        "path": str(parquet_files[split]),
+                        "batch_size": ARROW_BATCH_SIZE,
+                    },
+                )
+            else:
+                dataset[split] = (
+                    dataset[split]
+                    .with_format("arrow")
+                    .filter(
+                        pipelines[split].get_mask,
+                        batched=True,
+                        batch_size=ARROW_BATCH_SIZE,
+                    )
+                    .with_format(None)
+                )
+        output_columns = pipelines[split].output_columns
+        dataset[split] = dataset[split].map(
+            pipelines[split],
+            batched=True,
+            batch_size=BATCH_SIZE,
+            remove_columns=list(set(columns) - set(output_columns)),
+        )
+    return dataset, pipelines
+
+
+def get_byte_ranges(input_file: pathlib.Path, num_shards: int) -> list[tuple[int, int]]:
+    """Splits a JSONL file into at most `num_shards` byte ranges of about the same size,
+    each of which starts at the beginning of a line."""
+    file_size = input_file.stat().st_size
+    offsets = [0]
+    with input_file.open("rb") as f:
+        for shard_index in range(1, num_shards):
+            f.seek(max(file_size * shard_index // num_shards, offsets[-1]))
+            # Move to the beginning of the next line.
+            f.readline()
+            offsets.append(min(f.tell(), file_size))
+    offsets.append(file_size)
+    return [(start, end) for start, end in zip(offsets, offsets[1:]) if start < end]
+
+
+def filter_table(pipeline: FilterPipeline, table: pa.Table) -> dict[str, list[Any]]:
+    """Filters the examples of `table` with `pipeline`, applying the vectorized filters
+    to the Arrow batches first."""
+    outputs: dict[str, list[Any]] = {column: [] for column in pipeline.output_columns}
+    for record_batch in table.to_batches(max_chunksize=ARROW_BATCH_SIZE):
+        batch_table = pa.Table.from_batches([record_batch])
+        if pipeline.vectorized_stages:
+            batch_table = batch_table.filter(pipeline.get_mask(batch_table))
+        for offset in range(0, batch_table.num_rows, BATCH_SIZE):
+            batch = batch_table.slice(offset, BATCH_SIZE).to_pydict()
+            for column, values in pipeline(batch).items():
+                outputs[column] += values
+    return outputs
+
+
+def filter_file(
+    input_file: pathlib.Path, pipeline: FilterPipeline, writer: ParquetShardWriter
+) -> None:
+    """Filters the JSONL file block by block with `pipeline` into `writer`.
+
+    The offset where each block ends and the stats of the pipeline so far are given to
+    the writer as the position of the input, so a run resumed from the manifest of the
+    writer skips the input and restores the stats up to there.
+    """
+    start = 0
+    if writer.resume_position is not None:
+        start = writer.resume_position["offset"]
+        pipeline.add_stats(writer.resume_position["stats"])
+        logger.info(f"Skipping the first {start:,} bytes of {input_file}.")
+    file_size = input_file.stat().st_size
+    with tqdm.tqdm(
+        total=file_size, initial=start, unit="B", unit_scale=True
+    ) as progress_bar:
+        for table, end in read_jsonl_blocks(input_file, start, file_size, BLOCK_SIZE):
+            writer.write(
+                filter_table(pipeline, table),
+                position={"offset": end, "stats": pipeline.get_stats()},
+            )
+            progress_bar.update(end - progress_bar.n)
+
+
+# The pipeline of the split being filtered and its domain counts, which the worker
+# processes inherit by fork.
+shard_pipeline: FilterPipeline
+shard_domain_counts: Optional[collections.Counter[str]]
+
+
+def filter_shard(
+    input_file: pathlib.Path,
+    start: int,
+    end: int,
+    output_dir: pathlib.Path,
+    prefix: str,
+    writer_options: dict[str, Any],
+) -> tuple[list[dict[str, Any]], Optional[collections.Counter[str]]]:
+    """Filters the lines of `input_file` in [start, end) with `shard_pipeline` block by
+    block into a `ParquetShardWriter` of `prefix` with `writer_options`. Returns what
+    the pipeline recorded for the shard."""
+    shard_pipeline.reset_stats()
+    if shard_domain_counts is not None:
+        shard_domain_counts.clear()
+    with ParquetShardWriter(output_dir, prefix, **writer_options) as writer:
+        for table, _ in read_jsonl_blocks(input_file, start, end, BLOCK_SIZE):
+            writer.write(filter_table(shard_pipeline, table))
+    if not writer.output_files:
+        logger.info(f"No example is left in {prefix}, which is not written.")
+    return shard_pipeline.get_stats(), (
+        shard_domain_counts.copy() if shard_domain_counts is not None else None
+    )
+
+
+def reformat_and_filter_files(
+    data_files: dict[str, pathlib.Path],
+    dataset: DatasetDict,
+    dataset_name: str,
+    output_dir: pathlib.Path,
+    num_proc: int,
+    overwrite: bool = False,
+    strict: bool = False,
+    num_warmup_examples: int = 0,
+    profile: bool = False,
+    thresholds: Optional[dict[str, float]] = None,
+    compression_options: Optional[dict[str, Any]] = None,
+    domain_counts: Optional[dict[str, collections.Counter[str]]] = None,
+    writer_options: Optional[dict[str, Any]] = None,
+) -> dict[str, FilterPipeline]:
+    """Reformats and filters the JSONL file of every split in `num_proc` processes.
+
+    Each file is split into byte ranges aligned to lines, which are filtered
+    independently and written to `{output_dir}/{split}_{shard_index}_{index}.parquet`
+    by a `ParquetShardWriter` with `writer_options` (the row group size, the
+    compression, and the limits of a file). The shards are in the order of
+    the input, so the output is the same in any `num_proc`. `dataset` is only used to
+    sample the warmup examples.
+
+    Every finished shard is appended to `{output_dir}/{split}_shard_manifest.jsonl` with
+    the stats and the domain counts of the shard. Unless `overwrite`, the shards in the
+    manifest are not filtered again, and their stats and counts are taken from it.
+    """
+    global shard_pipeline, shard_domain_counts
+    pipelines: dict[str, FilterPipeline] = {}
+    for split, input_file in data_files.items():
+        shard_domain_counts = None
+        if domain_counts is not None:
+            shard_domain_counts = domain_counts[split] = collections.Counter()
+        shard_pipeline = pipelines[split] = get_pipeline(
+            dataset[split],
+            dataset_name,
+            strict=strict,
+            num_warmup_examples=num_warmup_examples,
+            profile=profile,
+            thresholds=thresholds,
+            compression_options=compression_options,
+            domain_counts=shard_domain_counts,
+        )
+        num_shards = max(num_proc, math.ceil(input_file.stat().st_size / SHARD_SIZE))
+        byte_ranges = get_byte_ranges(input_file, num_shards)
+        manifest_file = output_dir.joinpath(f"{split}_shard_manifest.jsonl")
+        done_shard_indices: set[int] = set()
+        if overwrite:
+            manifest_file.unlink(missing_ok=True)
+        else:
+            for entry in read_manifest(manifest_file):
+                byte_range = (entry["start"], entry["end"])
+                if byte_range not in byte_ranges[entry["index"] : entry["index"] + 1]:
+                    raise ValueError(
+                        f"The shards in {manifest_file} do not match the input. "
+                        "Specify the same --num_proc as the interrupted run."
+                    )
+                logger.info(f"Shard {entry['index']} of {input_file} is done.")
+                done_shard_indices.add(entry["index"])
+                shard_pipeline.add_stats(entry["stats"])
+                if shard_domain_counts is not None:
+                    shard_domain_counts.update(entry["domain_counts"])
+        shards = [
+            (shard_index, start, end)
+            for shard_index, (start, end) in enumerate(byte_ranges)
+            if shard_index not in done_shard_indices
+        ]
+        # The files of a shard that already exist are kept unless `overwrite`, and the
+        # writer discards the examples in them.
+        shard_writer_options = {**(writer_options or {}), "overwrite": overwrite}
+        logger.info(f"Filtering {len(shards):,} shards of {input_file}.")
+        with multiprocessing.get_context("fork").Pool(num_proc) as pool:
+            results = [
+                pool.apply_async(
+                    filter_shard,
+                    (
+                        input_file,
+                        start,
+                        end,
+                        output_dir,
+                        f"{split}_{shard_index}",
+                        shard_writer_options,
+                    ),
+                )
+                for shard_index, start, end in shards
+            ]
+            for (shard_index, start, end), result in zip(shards, results):
+                stats, counts = result.get()
+                shard_pipeline.add_stats(stats)
+                if shard_domain_counts is not None and counts is not None:
+                    shard_domain_counts.update(counts)
+                entry = {
+                    "index": shard_index,
+                    "start": start,
+                    "end": end,
+                    "stats": stats,
+                    "domain_counts": counts,
+                }
+                with manifest_file.open("a") as f:
+                    f.write(json.dumps(entry) + "\n")
+    return pipelines
+
+
+def write_domain_counts(
+    domain_counts: collections.Counter[str], output_file: pathlib.Path
+) -> None:
+    """Writes the number of documents per hostname in descending order."""
+    with output_file.open("w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["domain", "num_documents"])
+        writer.writerows(domain_counts.most_common())
+
+
+def write_quality_signals(
+    dataset: DatasetDict,
+    output_dir: pathlib.Path,
+    overwrite: bool = False,
+    compression_options: Optional[dict[str, Any]] = None,
+) -> None:
+    """Writes the quality signals of every example of ja_cc to
+    `{output_dir}/{split}_{chunk_index}.parquet`. The `index` column is the position of
+    the example in the input split."""
+    columns = get_column_names(dataset)
+    for split, ds in dataset.items():
+        reformat_fn = reformat_data("text")
+        signals_fn = add_quality_signals(**(compression_options or {}))
+        pipeline = FilterPipeline(
+            [
+                Stage("map", reformat_fn, get_stage_name(reformat_fn)),
+                Stage("map", signals_fn, get_stage_name(signals_fn)),
+            ],
+            output_columns=QUALITY_SIGNAL_COLUMNS,
+        )
+        ds = ds.map(
+            pipeline, batched=True, batch_size=BATCH_SIZE, remove_columns=columns
+        )
+        num_examples = 0
+        for chunk_index, batch in enumerate(tqdm.tqdm(ds.iter(batch_size=CHUNK_SIZE))):
+            chunk_size = len(batch["is_not_empty"])
+            output_file: pathlib.Path = output_dir.joinpath(
+                f"{split}_{chunk_index}.parquet"
+            )
+            if output_file.exists() and not overwrite:
+                logger.error(
+                    f"{output_file} already exists. Specify --overwrite to overwrite."
+                )
+            else:
+                batch["index"] = list(range(num_examples, num_examples + chunk_size))
+                Dataset.from_dict(batch).to_parquet(output_file)
+            num_examples += chunk_size
+
+
+def get_signal_predicates(
+    signals: pa.Table, thresholds: dict[str, float]
+) -> dict[str, pa.ChunkedArray]:
+    """Returns the judgments of the ja_cc filters computed from the quality signals, in
+    the order of `get_stages`."""
+    is_not_harmful_content = pa.chunked_array([pa.repeat(True, len(signals))])
+    for category in NG_WORDS_CATEGORIES:
+        is_not_harmful_content = pc.and_(
+            is_not_harmful_content,
+            pc.less_equal(signals[f"num_{category}_words"], thresholds["max_ng_words"]),
+        )
+    score = signals["compression_ratio"]
+    if thresholds["compression_length_factor"]:
+        length_penalty = pc.multiply(
+            pc.ln(pc.cast(signals["num_bytes"], pa.float64())),
+            thresholds["compression_length_factor"],
+        )
+        score = pc.add(score, length_penalty)
+    predicates = {
+        "has_valid_domain": signals["has_valid_domain"],
+        "is_not_empty": signals["is_not_empty"],
+        "is_japanese": pc.greater(signals["head_japanese_ratio"], 0.0),
+        "is_not_ad_content": pc.less_equal(
+            signals["num_ad_words"], thresholds["max_ad_words"]
+        ),
+        "is_not_harmful_content": is_not_harmful_content,
+        "has_good_average_sentence_length": pc.less_equal(
+            signals["average_sentence_length"],
+            thresholds["max_average_sentence_length"],
+        ),
+        "has_good_compression_ratio": pc.and_(
+            pc.greater_equal(score, thresholds["min_compression_ratio"]),
+            pc.less_equal(score, thresholds["max_compression_ratio"]),
+        ),
+    }
+    return {name: pc.fill_null(mask, False) for name, mask in predicates.items()}
+
+
+def filter_by_quality_signals(
+    dataset: DatasetDict,
+    signal_dir: pathlib.Path,
+    output_dir: pathlib.Path,
+    thresholds: dict[str, float],
+    writer_options: dict[str, Any],
+    overwrite: bool = False,
+    profile: bool = False,
+) -> dict[str, FilterPipeline]:
+    """Filters ja_cc with the quality signals written by `write_quality_signals`.
+
+    The filters are replaced by predicates on the signals, and only the maps run on the
+    texts of the remaining examples. The output is written by a `ParquetShardWriter`
+    with `writer_options` as in `--mode filter`, and its manifest records the chunks of
+    signals consumed, so a resumed run skips them.
+    """
+    pipelines: dict[str, FilterPipeline] = {}
+    for split, ds in dataset.items():
+        pipeline = FilterPipeline(
+            get_stages("ja_cc", thresholds=thresholds, include_filters=False),
+            output_columns=("text", "meta"),
+            profile=profile,
+        )
+        num_dropped: dict[str, int] = {}
+        num_examples = 0
+        with ParquetShardWriter(
+            output_dir,
+            split,
+            overwrite=overwrite,
+            manifest_file=output_dir.joinpath(f"{split}_manifest.jsonl"),
+            **writer_options,
+        ) as writer:
+            start_chunk_index = 0
+            if writer.resume_position is not None:
+                start_chunk_index = writer.resume_position["chunk_index"]
+                pipeline.add_stats(writer.resume_position["stats"])
+                num_dropped = writer.resume_position["num_dropped"]
+                logger.info(
+                    f"Skipping the first {start_chunk_index:,} chunks of {split}."
+                )
+            for chunk_index, batch in enumerate(
+                tqdm.tqdm(ds.iter(batch_size=CHUNK_SIZE))
+            ):
+                chunk_size = len(next(iter(batch.values())))
+                if chunk_index < start_chunk_index:
+                    num_examples += chunk_size
+                    continue
+
+                signals = pq.read_table(
+                    signal_dir.joinpath(f"{split}_{chunk_index}.parquet")
+                )
+                assert signals["index"].to_pylist() == list(
+                    range(num_examples, num_examples + chunk_size)
+                ), f"Signals of {split}_{chunk_index} do not match the input."
+                mask = pa.chunked_array([pa.repeat(True, chunk_size)])
+                for name, predicate in get_signal_predicates(
+                    signals, thresholds
+                ).items():
+                    num_dropped[name] = (
+                        num_dropped.get(name, 0)
+                        + pc.sum(pc.and_(mask, pc.invert(predicate))).as_py()
+                    )
+                    mask = pc.and_(mask, predicate)
+                selected = mask.to_pylist()
+                outputs = pipeline(
+                    {
+                        column: [value for value, s in zip(values, selected) if s]
+                        for column, values in batch.items()
+                    }
+                )
+                writer.write(
+                    outputs,
+                    position={
+                        "chunk_index": chunk_index + 1,
+                        "stats": pipeline.get_stats(),
+                        "num_dropped": dict(num_dropped),
+                    },
+                )
+                num_examples += chunk_size
+        for name, count in num_dropped.items():
+            logger.info(f"[{split}] {name}: {count:,} dropped.")
+        pipelines[split] = pipeline
+    return pipelines
 
 
 def main() -> None:
@@ -130,6 +693,14 @@ def main() -> None:
         type=str,
         help="Path to the data directory.",
     )
+    parser.add_argument(
+        "--input_format",
+        type=str,
+        default="jsonl",
+        choices=["jsonl", "parquet"],
+        help="Format of the input files. With parquet, the filters on the metadata "
+        "are pushed down into the scan.",
+    )
     parser.add_argument(
         "--output_dir",
         type=str,
@@ -140,12 +711,141 @@ def main() -> None:
         action="store_true",
         help="Whether to use strict filtering.",
     )
+    parser.add_argument(
+        "--mode",
+        type=str,
+        default="filter",
+        choices=["filter", "signals", "apply"],
+        help='"filter" filters the data. "signals" writes the quality signals of ja_cc '
+        'to the output directory, and "apply" filters ja_cc with the signals in '
+        "--signal_dir.",
+    )
+    parser.add_argument(
+        "--signal_dir",
+        type=str,
+        help="Path to the quality signals for --mode apply.",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=str,
+        action="append",
+        default=[],
+        help="Threshold of the ja_cc filters overriding the default, e.g., "
+        "min_compression_ratio=0.35. Can be specified multiple times.",
+    )
+    parser.add_argument(
+        "--compression_codec",
+        type=str,
+        default="zlib",
+        choices=["zlib", "zstd"],
+        help="Codec to estimate the compression ratio of ja_cc.",
+    )
+    parser.add_argument(
+        "--compression_level",
+        type=int,
+        default=9,
+        help="Compression level to estimate the compression ratio of ja_cc.",
+    )
+    parser.add_argument(
+        "--compression_max_bytes",
+        type=int,
+        default=None,
+        help="Maximum bytes of a text to compress (no limit by default).",
+    )
+    parser.add_argument(
+        "--compression_num_windows",
+        type=int,
+        default=1,
+        help="Number of windows sampled from a text longer than "
+        "--compression_max_bytes (1 means the prefix).",
+    )
+    parser.add_argument(
+        "--num_warmup_examples",
+        type=int,
+        default=0,
+        help="Number of examples to measure the filters on and reorder them by their "
+        "cost and rejection rate (0 means keeping the default order).",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Whether to record the time and the bytes processed by each filter.",
+    )
+    parser.add_argument(
+        "--print_report",
+        action="store_true",
+        help="Whether to print the report of each filter at exit.",
+    )
+    parser.add_argument(
+        "--parquet_row_group_size",
+        type=int,
+        default=10_000,
+        help="Number of examples per row group of the output parquet files.",
+    )
+    parser.add_argument(
+        "--parquet_compression",
+        type=str,
+        default="snappy",
+        choices=["none", "snappy", "gzip", "brotli", "lz4", "zstd"],
+        help="Codec to compress the output parquet files.",
+    )
+    parser.add_argument(
+        "--parquet_compression_level",
+        type=int,
+        default=None,
+        help="Compression level of --parquet_compression (the codec's default by "
+        "default).",
+    )
+    parser.add_argument(
+        "--output_shard_size",
+        type=int,
+        default=CHUNK_SIZE,
+        help="Maximum number of examples per output file.",
+    )
+    parser.add_argument(
+        "--output_shard_bytes",
+        type=int,
+        default=None,
+        help="Maximum bytes (uncompressed) per output file (no limit by default).",
+    )
+    parser.add_argument(
+        "--num_proc",
+        type=int,
+        default=1,
+        help="Number of processes to filter shards of the input in parallel. The "
+        "output of a shard is written to {split}_{shard_index}_{index}.parquet.",
+    )
     parser.add_argument(
         "--overwrite",
         action="store_true",
         help="Whether to overwrite the output directory.",
     )
     args = parser.parse_args()
+    if args.mode != "filter" and args.DATASET_NAME != "ja_cc":
+        parser.error(f"--mode {args.mode} is only supported for ja_cc.")
+    if args.mode == "apply" and args.signal_dir is None:
+        parser.error("--signal_dir is required for --mode apply.")
+    if args.num_proc > 1 and (args.mode != "filter" or args.input_format != "jsonl"):
+        parser.error("--num_proc is only supported for --mode filter of jsonl.")
+    if args.threshold and args.DATASET_NAME != "ja_cc":
+        parser.error("--threshold is only supported for ja_cc.")
+    try:
+        thresholds = parse_thresholds(args.threshold)
+    except ValueError as e:
+        parser.error(str(e))
+    compression_options = {
+        "codec": args.compression_codec,
+        "level": args.compression_level,
+        "max_bytes": args.compression_max_bytes,
+        "num_windows": args.compression_num_windows,
+    }
+    writer_options = {
+        "row_group_size": args.parquet_row_group_size,
+        "compression": args.parquet_compression,
+        "compression_level": args.parquet_compression_level,
+        "max_rows": args.output_shard_size,
+        "max_bytes": args.output_shard_bytes,
+    }
 
     input_dir: pathlib.Path = pathlib.Path(args.input_dir)
     output_dir: pathlib.Path = pathlib.Path(args.output_dir)
@@ -154,32 +854,122 @@ def main() -> None:
     start_time = time.time()
 
     logger.info("Loading the dataset")
+    data_files = get_data_files(input_dir, args.input_format)
     dataset: DatasetDict = load_dataset(
-        "json",
-        data_files={k: str(v) for k, v in get_data_files(input_dir, "jsonl").items()},
+        "json" if args.input_format == "jsonl" else "parquet",
+        data_files={k: str(v) for k, v in data_files.items()},
         streaming=True,
     )
 
-    dataset = reformat_and_filter_dataset(
-        dataset, args.DATASET_NAME, strict=args.strict
-    )
-
-    logger.info(f"Writing the reformatted data to {output_dir}.")
-    for split, ds in dataset.items():
-        chunk_index = 0
-        for batch in tqdm.tqdm(ds.iter(batch_size=CHUNK_SIZE)):
-            output_file: pathlib.Path = output_dir.joinpath(
-                f"{split}_{chunk_index}.parquet"
+    domain_counts: dict[str, collections.Counter[str]] = {}
+    if args.mode == "signals":
+        logger.info(f"Writing the quality signals to {output_dir}.")
+        write_quality_signals(
+            dataset,
+            output_dir,
+            overwrite=args.overwrite,
+            compression_options=compression_options,
+        )
+        logger.info(
+            f"Finished writing the quality signals. "
+            f"Elapsed time: {time.time() - start_time} [sec]"
+        )
+        return
+    elif args.mode == "apply":
+        logger.info(f"Filtering the dataset with the signals in {args.signal_dir}.")
+        pipelines = filter_by_quality_signals(
+            dataset,
+            pathlib.Path(args.signal_dir),
+            output_dir,
+            thresholds={**get_thresholds(args.strict), **thresholds},
+            writer_options=writer_options,
+            overwrite=args.overwrite,
+            profile=args.profile,
+        )
+    elif args.num_proc > 1:
+        logger.info(f"Filtering the dataset in {args.num_proc} processes.")
+        pipelines = reformat_and_filter_files(
+            {str(k): v for k, v in data_files.items()},
+            dataset,
+            args.DATASET_NAME,
+            output_dir,
+            args.num_proc,
+            overwrite=args.overwrite,
+            strict=args.strict,
+            num_warmup_examples=args.num_warmup_examples,
+            profile=args.profile,
+            thresholds=thresholds,
+            compression_options=compression_options,
+            domain_counts=domain_counts if args.DATASET_NAME == "ja_cc" else None,
+            writer_options=writer_options,
+        )
+    elif args.input_format == "jsonl":
+        logger.info(f"Filtering the dataset into {output_dir}.")
+        pipelines = {}
+        for split, input_file in data_files.items():
+            split_domain_counts: Optional[collections.Counter[str]] = None
+            if args.DATASET_NAME == "ja_cc":
+                split_domain_counts = domain_counts[split] = collections.Counter()
+            pipelines[split] = get_pipeline(
+                dataset[split],
+                args.DATASET_NAME,
+                strict=args.strict,
+                num_warmup_examples=args.num_warmup_examples,
+                profile=args.profile,
+                thresholds=thresholds,
+                compression_options=compression_options,
+                domain_counts=split_domain_counts,
             )
-            if output_file.exists() and not args.overwrite:
-                logger.error(
-                    f"{output_file} already exists. Specify --overwrite to overwrite."
-                )
-                chunk_index += 1
-                continue
+            with ParquetShardWriter(
+                output_dir,
+                split,
+                overwrite=args.overwrite,
+                manifest_file=output_dir.joinpath(f"{split}_manifest.jsonl"),
+                **writer_options,
+            ) as writer:
+                if (
+                    writer.resume_position is not None
+                    and split_domain_counts is not None
+                ):
+                    logger.warning(
+                        "The domain counts only cover the input after the resumed "
+                        "position."
+                    )
+                filter_file(input_file, pipelines[split], writer)
+    else:
+        dataset, pipelines = reformat_and_filter_dataset(
+            dataset,
+            args.DATASET_NAME,
+            strict=args.strict,
+            num_warmup_examples=args.num_warmup_examples,
+            profile=args.profile,
+            thresholds=thresholds,
+            compression_options=compression_options,
+            parquet_files={str(k): v for k, v in data_files.items()},
+            domain_counts=domain_counts if args.DATASET_NAME == "ja_cc" else None,
+        )
+        logger.info(f"Writing the reformatted data to {output_dir}.")
+        for split, ds in dataset.items():
+            with ParquetShardWriter(
+                output_dir,
+                split,
+                overwrite=args.overwrite,
+                **writer_options,
+            ) as writer:
+                for batch in tqdm.tqdm(ds.iter(batch_size=BATCH_SIZE)):
+                    writer.write(batch)
+
+    for split, counts in domain_counts.items():
+        write_domain_counts(counts, output_dir.joinpath(f"{split}_domain_counts.csv"))
+
+    for split, pipeline in pipelines.items():
+        pipeline.log_stats(prefix=f"[{split}] ")
+        pipeline.write_report(output_dir.joinpath(f"{split}_report"))
 
-            Dataset.from_dict(batch).to_parquet(output_file)
-            chunk_index += 1
+    if args.print_report:
+        for split, pipeline in pipelines.items():
+            print(f"[{split}]")
+            print(pipeline.format_report())
 
     end_time = time.time()
     logger.info(
@@ -1,3 +1,5 @@
+import collections
+import functools
 import math
 import typing
 import zlib
@@ -5,13 +7,14 @@ from pathlib import Path
 from typing import Any, Callable
 from urllib.parse import urlparse
 
+import pyarrow as pa
+import pyarrow.compute as pc
 import regex
 from hojichar import Document
 from hojichar.filters.document_filters import (
     AcceptJapanese,
     DiscardAds,
     DiscardRareKuten,
-    NgWordsFilterJa,
 )
 
 BASE_PATH = Path(__file__).parent
@@ -27,6 +30,31 @@ def reformat_data(text_field: str) -> Callable[..., dict[str, Any]]:
     return reformat
 
 
+# The prefix of a URL up to the end of its network location, which `urlparse` takes the
+# hostname from. URLs of the same host mostly share it, so it is used as a cache key.
+URL_NETLOC_PREFIX_PAT = regex.compile(r"[^/?#]*(?://[^/?#]*)?")
+
+
+def get_url_netloc_prefix(url: str) -> str:
+    # `urlparse` removes tabs and newlines anywhere in the URL, which may form "//".
+    if "\t" in url or "\r" in url or "\n" in url:
+        return url
+    m = URL_NETLOC_PREFIX_PAT.match(url)
+    assert m is not None
+    return m.group()
+
+
+@functools.lru_cache(maxsize=2**16)
+def get_domain(url_netloc_prefix: str) -> typing.Optional[str]:
+    return urlparse(url_netloc_prefix).hostname
+
+
+def get_url_domain(url: str) -> typing.Optional[str]:
+    """Returns the hostname of the URL, which is cached for the most recent URL
+    prefixes up to the end of the network location."""
+    return get_domain(get_url_netloc_prefix(url))
+
+
 def has_valid_domain() -> Callable[..., bool]:
     dict_path = BASE_PATH.joinpath("dict/ja_valid_domains.txt")
     valid_domains = set(dict_path.read_text().splitlines())
@@ -34,14 +62,33 @@ def has_valid_domain() -> Callable[..., bool]:
     def judge(example: dict[str, Any]) -> bool:
         if example["meta"]["url"].startswith("https://ja.wikipedia.org/"):
             return False
-        domain: typing.Optional[str] = urlparse(example["meta"]["url"]).hostname
-        assert domain is not None
+        domain: typing.Optional[str] = get_url_domain(example["meta"]["url"])
+        if domain is None:
+            return False
         tld = domain.split(".")[-1]
         return tld in valid_domains
 
     return judge
 
 
+def count_domains(
+    domain_counts: collections.Counter[str],
+) -> Callable[..., dict[str, Any]]:
+    """Counts the documents per hostname of the URL into `domain_counts`."""
+
+    def count(example: dict[str, Any]) -> dict[str, Any]:
+        try:
+            domain = get_url_domain(example["meta"]["url"])
+        except ValueError:
+            # e.g., an invalid IPv6 address, which `has_valid_domain` judges.
+            return example
+        if domain is not None:
+            domain_counts[domain] += 1
+        return example
+
+    return count
+
+
 def has_valid_extension() -> Callable[..., bool]:
     dict_path = BASE_PATH.joinpath("dict/code_valid_extensions.txt")
     valid_extensions = set(dict_path.read_text().splitlines())
@@ -83,8 +130,122 @@ def has_valid_alphanum_fraction(
     return judge
 
 
+def has_valid_pile_set_name(
+    invalid_pile_set_names: tuple[str, ...] = ("Books3",)
+) -> Callable[..., bool]:
+    def judge(example: dict[str, Any]) -> bool:
+        return example["meta"]["pile_set_name"] not in invalid_pile_set_names
+
+    return judge
+
+
+def get_meta_field(schema: pa.Schema, key: str) -> pc.Expression:
+    """Returns the field of the input that `reformat_data` puts in `meta[key]`, i.e.,
+    the column `key` if the input has one, or else the field `key` of `meta`."""
+    return pc.field(key) if key in schema.names else pc.field("meta", key)
+
+
+# The following are the filters on `meta` above as expressions on the input, which are
+# evaluated on record batches or pushed down into a parquet scan. Rows whose field is
+# null are rejected except by `has_valid_pile_set_name_expression`, as with the filters.
+def has_valid_extension_expression() -> Callable[[pa.Schema], pc.Expression]:
+    dict_path = BASE_PATH.joinpath("dict/code_valid_extensions.txt")
+    valid_extensions = sorted(set(dict_path.read_text().splitlines()))
+
+    def get_expression(schema: pa.Schema) -> pc.Expression:
+        return get_meta_field(schema, "ext").isin(valid_extensions)
+
+    return get_expression
+
+
+def has_valid_max_line_length_expression(
+    allowed_max_line_length: int = 1_000,
+) -> Callable[[pa.Schema], pc.Expression]:
+    def get_expression(schema: pa.Schema) -> pc.Expression:
+        return get_meta_field(schema, "max_line_length") <= allowed_max_line_length
+
+    return get_expression
+
+
+def has_valid_avg_line_length_expression(
+    allowed_avg_line_length: int = 100,
+) -> Callable[[pa.Schema], pc.Expression]:
+    def get_expression(schema: pa.Schema) -> pc.Expression:
+        return get_meta_field(schema, "avg_line_length") <= allowed_avg_line_length
+
+    return get_expression
+
+
+def has_valid_alphanum_fraction_expression(
+    allowed_alphanum_fraction: float = 0.25,
+) -> Callable[[pa.Schema], pc.Expression]:
+    def get_expression(schema: pa.Schema) -> pc.Expression:
+        return get_meta_field(schema, "alphanum_fraction") >= allowed_alphanum_fraction
+
+    return get_expression
+
+
+def has_valid_pile_set_name_expression(
+    invalid_pile_set_names: tuple[str, ...] = ("Books3",)
+) -> Callable[[pa.Schema], pc.Expression]:
+    def get_expression(schema: pa.Schema) -> pc.Expression:
+        # `is_in` is false for null, so null is accepted as `None not in (...)` is.
+        return ~get_meta_field(schema, "pile_set_name").isin(
+            list(invalid_pile_set_names)
+        )
+
+    return get_expression
+
+
+def get_compression_ratio_fn(
+    codec: str = "zlib",
+    level: int = 9,
+    max_bytes: typing.Optional[int] = None,
+    num_windows: int = 1,
+) -> Callable[[bytes], float]:
+    """Returns a function estimating the compression ratio of a byte stream.
+
+    Args:
+        codec: "zlib" (deflate), or "zstd" which requires the `zstandard` package.
+        level: The compression level.
+        max_bytes: If given, at most this many bytes are compressed.
+        num_windows: If the stream is longer than `max_bytes`, this many evenly spaced
+            windows of `max_bytes // num_windows` bytes are compressed together. 1 means
+            the prefix of the stream.
+    """
+    if num_windows < 1 or (max_bytes is not None and max_bytes < num_windows):
+        raise ValueError(f"Invalid windows: {num_windows} in {max_bytes} bytes.")
+    compress: Callable[[bytes], bytes]
+    if codec == "zlib":
+        compress = functools.partial(zlib.compress, level=level)
+    elif codec == "zstd":
+        import zstandard
+
+        compress = zstandard.ZstdCompressor(level=level).compress
+    else:
+        raise ValueError(f"Unknown codec: {codec}.")
+
+    def get_ratio(encoded: bytes) -> float:
+        if max_bytes is not None and len(encoded) > max_bytes:
+            if num_windows == 1:
+                encoded = encoded[:max_bytes]
+            else:
+                window_size = max_bytes // num_windows
+                stride = (len(encoded) - window_size) // (num_windows - 1)
+                encoded = b"".join(
+                    encoded[i * stride : i * stride + window_size]
+                    for i in range(num_windows)
+                )
+        return len(compress(encoded)) / len(encoded)
+
+    return get_ratio
+
+
 def has_good_compression_ratio(
-    min_score: float = 0.3, max_score: float = 0.7, length_factor: float = 0.0
+    min_score: float = 0.3,
+    max_score: float = 0.7,
+    length_factor: float = 0.0,
+    **compression_options: Any,
 ) -> Callable[..., bool]:
     """Checks if data compression (deflate) yields a desired size of data stream.
 
@@ -105,6 +266,8 @@ def has_good_compression_ratio(
         max_score: The upper bound of the compression ratio.
         length_factor: Penalty factor of log(original_byte_length), usually set to
             something larger than 0. Using 0 falls back to a simple compression ratio.
+        **compression_options: Passed to `get_compression_ratio_fn` to use a faster
+            estimate of the ratio. The default is deflate (level 9) of the whole stream.
 
     Returns:
         Judgment function, bound with `min` and `max`.
@@ -119,12 +282,15 @@ def has_good_compression_ratio(
         True  # 0.92
     """
 
+    get_ratio = get_compression_ratio_fn(**compression_options)
+
     def judge(example: dict[str, Any]) -> bool:
         encoded = example["text"].encode("utf-8")
-        compressed = zlib.compress(encoded, level=9)
         encoded_length = len(encoded)
-        compressed_length = len(compressed)
-        ratio = compressed_length / encoded_length
+        if encoded_length == 0:
+            # The ratio is undefined, and an empty text is rejected anyway.
+            return False
+        ratio = get_ratio(encoded)
         length_penalty = (
             length_factor * math.log(encoded_length) if length_factor else 0.0
         )
@@ -165,36 +331,165 @@ def has_good_average_sentence_length(
     return judge
 
 
-def is_not_adult_content(max_allowed_num: int = 3) -> Callable[..., bool]:
-    dict_path = BASE_PATH.joinpath("dict/ja_adult_keywords.txt")
+NG_WORDS_CATEGORIES: tuple[str, ...] = ("adult", "discrimination", "violence")
+
+
+class NgWordsCounter:
+    """Counts NG words of several categories in a single pass over a text.
 
-    # Monkey patch for hojichar
-    def apply(self, doc):
-        if len(self.keyword_pat.findall(doc.text)) > max_allowed_num:
-            doc.is_rejected = True
-        return doc
+    The keywords of all the categories are merged into one trie, which is walked from
+    every position of the text. For each category, the counts are identical to
+    `len(NgWordsFilterJa(dict_path, ignore_confused).keyword_pat.findall(text))`:
+    a match at a position is the first keyword in the dictionary order (non-katakana
+    keywords first, then katakana keywords) and the next match of the same category
+    starts after its end. With `ignore_confused`, a katakana keyword only matches if it
+    is not adjacent to other katakana.
+    """
+
+    _KATAKANA_PAT = regex.compile(r"[ァ-ヴー]+")
+    _TERMINAL = ""  # Never a character of the text.
+
+    def __init__(self, dict_paths: dict[str, Path], ignore_confused: bool = True):
+        self.categories: list[str] = list(dict_paths.keys())
+        self.root: dict[str, Any] = {}
+        for category_index, dict_path in enumerate(dict_paths.values()):
+            # Same as `NgWordsFilterJa.__init__`.
+            words = [
+                w.strip()
+                for w in dict_path.read_text(encoding="utf-8").split("\n")
+                if len(w) != 0
+            ]
+            for word_index, word in enumerate(words):
+                if word == "":
+                    continue
+                is_katakana = (
+                    ignore_confused and self._KATAKANA_PAT.fullmatch(word) is not None
+                )
+                priority = word_index + len(words) if is_katakana else word_index
+                node = self.root
+                for char in word:
+                    node = node.setdefault(char, {})
+                node.setdefault(self._TERMINAL, []).append(
+                    (category_index, priority, is_katakana)
+                )
+
+    @staticmethod
+    def _is_katakana(char: str) -> bool:
+        return "ァ" <= char <= "ヴ" or char == "ー"
+
+    def count(
+        self,
+        text: str,
+        max_allowed_nums: typing.Optional[dict[str, int]] = None,
+        stop_on_reject: bool = False,
+    ) -> dict[str, int]:
+        """Returns the number of NG words per category.
+
+        Args:
+            text: The text to scan.
+            max_allowed_nums: If given, a category stops being counted once its count
+                exceeds the value, and the scan ends when every category has.
+            stop_on_reject: If True, the scan ends as soon as any category exceeds its
+                value in `max_allowed_nums`.
+        """
+        num_categories = len(self.categories)
+        counts = [0] * num_categories
+        # The position from which the next match of each category may start.
+        next_starts = [0] * num_categories
+        limits = [
+            max_allowed_nums.get(category) if max_allowed_nums else None
+            for category in self.categories
+        ]
+        num_active = num_categories
+        text_length = len(text)
+        terminal = self._TERMINAL
+        is_katakana = self._is_katakana
+        for start, char in enumerate(text):
+            node = self.root.get(char)
+            if node is None:
+                continue
+            best: typing.Optional[dict[int, tuple[int, int]]] = None
+            end = start
+            while True:
+                end += 1
+                entries = node.get(terminal)
+                if entries is not None:
+                    for category_index, priority, katakana in entries:
+                        if next_starts[category_index] > start:
+                            continue
+                        if katakana and (
+                            (start > 0 and is_katakana(text[start - 1]))
+                            or (end < text_length and is_katakana(text[end]))
+                        ):
+                            continue
+                        if best is None:
+                            best = {}
+                        current = best.get(category_index)
+                        if current is None or priority < current[0]:
+                            best[category_index] = (priority, end)
+                if end >= text_length:
+                    break
+                node = node.get(text[end])
+                if node is None:
+                    break
+            if best is None:
+                continue
+            for category_index, (_, match_end) in best.items():
+                counts[category_index] += 1
+                next_starts[category_index] = match_end
+                limit = limits[category_index]
+                if limit is not None and counts[category_index] > limit:
+                    next_starts[category_index] = text_length + 1
+                    num_active -= 1
+                    if stop_on_reject or num_active == 0:
+                        return dict(zip(self.categories, counts))
+        return dict(zip(self.categories, counts))
+
+
+def get_ng_words_counter(
+    categories: typing.Iterable[str] = NG_WORDS_CATEGORIES,
+) -> NgWordsCounter:
+    return NgWordsCounter(
+        {
+            category: BASE_PATH.joinpath(f"dict/ja_{category}_keywords.txt")
+            for category in categories
+        },
+        ignore_confused=True,
+    )
 
-    content_filter = NgWordsFilterJa(dict_path, ignore_confused=True)
-    content_filter.apply = apply.__get__(content_filter, NgWordsFilterJa)
+
+def is_not_harmful_content(
+    max_allowed_num: int = 3,
+    categories: typing.Iterable[str] = NG_WORDS_CATEGORIES,
+) -> Callable[..., bool]:
+    """Rejects a text if it contains more than `max_allowed_num` NG words of any
+    category. Equivalent to chaining `is_not_{category}_content` for all the categories,
+    but the text is scanned only once.
+    """
+    counter = get_ng_words_counter(categories)
+    max_allowed_nums = {category: max_allowed_num for category in counter.categories}
 
     def judge(example: dict[str, Any]) -> bool:
-        doc = content_filter.apply(Document(example["text"]))
-        return not doc.is_rejected
+        counts = counter.count(example["text"], max_allowed_nums, stop_on_reject=True)
+        return all(count <= max_allowed_num for count in counts.values())
 
     return judge
 
 
+def is_not_adult_content(max_allowed_num: int = 3) -> Callable[..., bool]:
+    return is_not_harmful_content(max_allowed_num, ["adult"])
+
+
 def is_not_discrimination_content(max_allowed_num: int = 3) -> Callable[..., bool]:
-    dict_path = BASE_PATH.joinpath("dict/ja_discrimination_keywords.txt")
+    return is_not_harmful_content(max_allowed_num, ["discrimination"])
+
 
-    # Monkey patch for hojichar
-    def apply(self, doc):
-        if len(self.keyword_pat.findall(doc.text)) > max_allowed_num:
-            doc.is_rejected = True
-        return doc
+def is_not_violence_content(max_allowed_num: int = 3) -> Callable[..., bool]:
+    return is_not_harmful_content(max_allowed_num, ["violence"])
 
-    content_filter = NgWordsFilterJa(dict_path, ignore_confused=True)
-    content_filter.apply = apply.__get__(content_filter, NgWordsFilterJa)
+
+def is_not_ad_content(max_allowed_num: int = 10) -> Callable[..., bool]:
+    content_filter = DiscardAds(max_allowed_num=max_allowed_num)
 
     def judge(example: dict[str, Any]) -> bool:
         doc = content_filter.apply(Document(example["text"]))
@@ -203,90 +498,165 @@ def is_not_discrimination_content(max_allowed_num: int = 3) -> Callable[..., boo
     return judge
 
 
-def is_not_violence_content(max_allowed_num: int = 3) -> Callable[..., bool]:
-    dict_path = BASE_PATH.joinpath("dict/ja_violence_keywords.txt")
+def add_quality_signals(**compression_options: Any) -> Callable[..., dict[str, Any]]:
+    """Adds the raw scores that the ja_cc filters compare with their thresholds.
 
-    # Monkey patch for hojichar
-    def apply(self, doc):
-        if len(self.keyword_pat.findall(doc.text)) > max_allowed_num:
-            doc.is_rejected = True
-        return doc
+    Each judgment can be reproduced from the scores (see
+    `filter_data.get_signal_predicates`), so the thresholds can be tuned without
+    scanning the texts again.
+    """
+    is_valid_domain = has_valid_domain()
+    japanese_pat = regex.compile(r"[ぁ-んァ-ン]")
+    # Same as `AcceptJapanese.lookup_size`.
+    japanese_lookup_size = 50
+    ad_keyword_pat = DiscardAds().keyword_pat
+    ng_words_counter = get_ng_words_counter()
+    get_compression_ratio = get_compression_ratio_fn(**compression_options)
+
+    def add(example: dict[str, Any]) -> dict[str, Any]:
+        text: str = example["text"]
+        encoded = text.encode("utf-8")
+        num_kuten = text.count("。")
+        head = text[:japanese_lookup_size]
+        example["has_valid_domain"] = is_valid_domain(example)
+        example["is_not_empty"] = text.strip() != ""
+        example["head_japanese_ratio"] = (
+            len(japanese_pat.findall(head)) / len(head) if head else 0.0
+        )
+        example["japanese_ratio"] = (
+            len(japanese_pat.findall(text)) / len(text) if text else 0.0
+        )
+        example["num_ad_words"] = len(ad_keyword_pat.findall(text))
+        for category, count in ng_words_counter.count(text).items():
+            example[f"num_{category}_words"] = count
+        if num_kuten > 0:
+            example["average_sentence_length"] = len(text) / num_kuten
+        else:
+            example["average_sentence_length"] = math.inf if text else 0.0
+        example["num_bytes"] = len(encoded)
+        example["compression_ratio"] = (
+            get_compression_ratio(encoded) if encoded else None
+        )
+        return example
 
-    content_filter = NgWordsFilterJa(dict_path, ignore_confused=True)
-    content_filter.apply = apply.__get__(content_filter, NgWordsFilterJa)
+    return add
 
-    def judge(example: dict[str, Any]) -> bool:
-        doc = content_filter.apply(Document(example["text"]))
-        return not doc.is_rejected
 
-    return judge
+QUALITY_SIGNAL_COLUMNS: tuple[str, ...] = (
+    "has_valid_domain",
+    "is_not_empty",
+    "head_japanese_ratio",
+    "japanese_ratio",
+    "num_ad_words",
+    *(f"num_{category}_words" for category in NG_WORDS_CATEGORIES),
+    "average_sentence_length",
+    "num_bytes",
+    "compression_ratio",
+)
 
 
-def is_not_ad_content(max_allowed_num: int = 10) -> Callable[..., bool]:
-    content_filter = DiscardAds(max_allowed_num=max_allowed_num)
+JAPANESE_PAT = regex.compile(r"[\p{Script=Hiragana}\p{Script=Katakana}ー]")
+URL_PAT = regex.compile(r"https?://[\w/:%#\$&\?\(\)~\.=\+\-]+")
+# 100 or more ASCII characters. "\n" is excluded as the lines are joined with it and a
+# run must not continue to the next line.
+SCRIPT_PAT = regex.compile(r"[\u0000-\u0009\u000B-\u007F]{100,}")
 
-    def judge(example: dict[str, Any]) -> bool:
-        doc = content_filter.apply(Document(example["text"]))
-        return not doc.is_rejected
 
-    return judge
+def get_japanese_text(text: str) -> str:
+    """Keeps the lines containing hiragana or katakana, removes URLs and long ASCII
+    runs (e.g. scripts) from them, and concatenates them without newlines."""
+    lines = "\n".join(line for line in text.split("\n") if JAPANESE_PAT.search(line))
+    return SCRIPT_PAT.sub("", URL_PAT.sub("", lines)).replace("\n", "")
+
+
+def get_japanese_texts(texts: list[str]) -> list[str]:
+    return [get_japanese_text(text) for text in texts]
 
 
 def extract_japanese_text() -> Callable[..., dict[str, Any]]:
     def extract(example: dict[str, Any]) -> dict[str, Any]:
-        ja_pat = regex.compile(r"[\p{Script=Hiragana}\p{Script=Katakana}ー]+")
-        script_pat = regex.compile(
-            r"[\u0000-\u007F\u0020-\u002F\u003A-\u0040\u005B-\u0060\u007B-\u007E]{100,}"
-        )
-        url_pat = regex.compile(r"https?://[\w/:%#\$&\?\(\)~\.=\+\-]+")
-
-        def regex_filter(sentence: str, pat) -> str:
-            valid: str = ""
-            index: int = 0
-            for m in pat.finditer(sentence):
-                valid += sentence[index : m.start()]
-                index = m.end()
-            valid += sentence[index:]
-            return valid
-
-        valid: str = ""
-        for sentence in example["text"].split("\n"):
-            if ja_pat.search(sentence):
-                sentence = regex_filter(sentence, url_pat)
-                sentence = regex_filter(sentence, script_pat)
-                valid += sentence
-        example["text"] = valid
+        example["text"] = get_japanese_text(example["text"])
         return example
 
     return extract
 
 
+WIKIPEDIA_FOOTNOTE_SECTIONS: tuple[str, ...] = (
+    "脚注",
+    "関連項目",
+    "日本国内の関連項目",
+    "出典",
+    "出典・脚注",
+    "参照",
+    "外部リンク",
+    "参考文献",
+    "その他関連事項",
+    "Footnotes",
+    "See also",
+    "Further reading",
+    "Bibliography",
+    "References",
+    "Notes",
+    "Citations",
+    "Sources",
+    "External links",
+)
+WIKIPEDIA_FOOTNOTE_PAT = regex.compile(
+    rf"\n({'|'.join(WIKIPEDIA_FOOTNOTE_SECTIONS)})\s*\n"
+)
+JA_PARENTHESIS_OPEN_PAT = regex.compile(r"（[\s,，、;；]*")
+JA_PARENTHESIS_CLOSE_PAT = regex.compile(r"[\s,，、;；]*）")
+EN_PARENTHESIS_OPEN_PAT = regex.compile(r"\([\s,;]*")
+EN_PARENTHESIS_CLOSE_PAT = regex.compile(r"[\s,;]*\)")
+EN_EMPTY_PARENTHESIS_PAT = regex.compile(r"\s?\(\)")
+
+
+def get_text_without_wikipedia_footnote(text: str) -> str:
+    """Truncates the text at the first footnote section (e.g. "脚注" or "References")."""
+    m = WIKIPEDIA_FOOTNOTE_PAT.search(text)
+    return text[: m.start()] if m else text
+
+
+def get_text_without_empty_parenthesis(text: str) -> str:
+    """Removes separators (whitespaces, commas, and semicolons) just inside parentheses,
+    and then removes the parentheses left empty.
+
+    A pass is skipped when the text has no parenthesis it could match. As no pass
+    removes a parenthesis without its pair, the rest of the passes are unaffected.
+    """
+    # Japanese
+    has_open = "（" in text
+    has_close = "）" in text
+    if has_open:
+        text = JA_PARENTHESIS_OPEN_PAT.sub("（", text)
+    if has_close:
+        text = JA_PARENTHESIS_CLOSE_PAT.sub("）", text)
+    if has_open and has_close:
+        # No separator is left just inside the parentheses.
+        text = text.replace("（）", "")
+    # English
+    has_open = "(" in text
+    has_close = ")" in text
+    if has_open:
+        text = EN_PARENTHESIS_OPEN_PAT.sub("(", text)
+    if has_close:
+        text = EN_PARENTHESIS_CLOSE_PAT.sub(")", text)
+    if has_open and has_close:
+        text = EN_EMPTY_PARENTHESIS_PAT.sub("", text)
+    return text
+
+
+def get_clean_wikipedia_text(text: str) -> str:
+    return get_text_without_empty_parenthesis(get_text_without_wikipedia_footnote(text))
+
+
+def get_clean_wikipedia_texts(texts: list[str]) -> list[str]:
+    return [get_clean_wikipedia_text(text) for text in texts]
+
+
 def remove_wikipedia_footnote() -> Callable[..., dict[str, Any]]:
     def remove(example: dict[str, Any]) -> dict[str, Any]:
-        footnote_sections: list[str] = [
-            "脚注",
-            "関連項目",
-            "日本国内の関連項目",
-            "出典",
-            "出典・脚注",
-            "参照",
-            "外部リンク",
-            "参考文献",
-            "その他関連事項",
-            "Footnotes",
-            "See also",
-            "Further reading",
-            "Bibliography",
-            "References",
-            "Notes",
-            "Citations",
-            "Sources",
-            "External links",
-        ]
-        footnote_pat = regex.compile(rf"\n({'|'.join(footnote_sections)})\s*\n")
-        m = footnote_pat.search(example["text"])
-        if m:
-            example["text"] = example["text"][: m.start()]
+        example["text"] = get_text_without_wikipedia_footnote(example["text"])
         return example
 
     return remove
@@ -294,14 +664,18 @@ def remove_wikipedia_footnote() -> Callable[..., dict[str, Any]]:
 
 def remove_empty_parenthesis() -> Callable[..., dict[str, Any]]:
     def remove(example: dict[str, Any]) -> dict[str, Any]:
-        # Japanese
-        example["text"] = regex.sub(r"（[\s,，、;；]*", "（", example["text"])
-        example["text"] = regex.sub(r"[\s,，、;；]*）", "）", example["text"])
-        example["text"] = regex.sub(r"（\s*）", "", example["text"])
-        # English
-        example["text"] = regex.sub(r"\([\s,;]*", "(", example["text"])
-        example["text"] = regex.sub(r"[\s,;]*\)", ")", example["text"])
-        example["text"] = regex.sub(r"\s?\(\s*\)", "", example["text"])
+        example["text"] = get_text_without_empty_parenthesis(example["text"])
         return example
 
     return remove
+
+
+def clean_wikipedia_text() -> Callable[..., dict[str, Any]]:
+    """Equivalent to `remove_wikipedia_footnote` followed by `remove_empty_parenthesis`
+    as a single map."""
+
+    def clean(example: dict[str, Any]) -> dict[str, Any]:
+        example["text"] = get_clean_wikipedia_text(example["text"])
+        return example
+
+    return clean
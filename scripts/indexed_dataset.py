@@ -0,0 +1,214 @@
+import logging
+import os
+import pathlib
+import struct
+from collections.abc import Sequence
+from typing import Any, BinaryIO, Optional, Union
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from parquet_writer import get_temporary_file
+
+logger = logging.getLogger(__name__)
+
+# The header of the index files of Megatron-LM's MMapIndexedDataset.
+INDEX_MAGIC = b"MMIDIDX\x00\x00"
+INDEX_VERSION = 1
+DTYPE_CODES: dict[np.dtype, int] = {
+    np.dtype(np.uint8): 1,
+    np.dtype(np.int8): 2,
+    np.dtype(np.int16): 3,
+    np.dtype(np.int32): 4,
+    np.dtype(np.int64): 5,
+    np.dtype(np.float64): 6,
+    np.dtype(np.float32): 7,
+    np.dtype(np.uint16): 8,
+}
+CODE_DTYPES: dict[int, np.dtype] = {code: dtype for dtype, code in DTYPE_CODES.items()}
+
+
+def get_bin_file(prefix: pathlib.Path) -> pathlib.Path:
+    return prefix.with_name(f"{prefix.name}.bin")
+
+
+def get_index_file(prefix: pathlib.Path) -> pathlib.Path:
+    return prefix.with_name(f"{prefix.name}.idx")
+
+
+def get_token_dtype(vocab_size: int) -> np.dtype:
+    """Returns the narrowest dtype for the token IDs of a vocabulary, as Megatron-LM
+    chooses it. int32 is used above uint16, as Megatron-LM has no code for uint32."""
+    return np.dtype(np.uint16) if vocab_size < 65500 else np.dtype(np.int32)
+
+
+def read_index(
+    index_file: pathlib.Path,
+) -> tuple[np.dtype, np.ndarray, np.ndarray, np.ndarray]:
+    """Reads an index file. Returns the dtype of the token IDs, the number of tokens
+    and the offset in bytes in the .bin file of each sequence, and the index of the
+    first sequence of each document followed by the number of sequences. The arrays
+    are memory-mapped."""
+    with index_file.open("rb") as f:
+        if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            raise ValueError(f"{index_file} is not an index file of Megatron-LM.")
+        (version,) = struct.unpack("<Q", f.read(8))
+        if version != INDEX_VERSION:
+            raise ValueError(f"The version {version} of {index_file} is unsupported.")
+        (code,) = struct.unpack("<B", f.read(1))
+        (num_sequences,) = struct.unpack("<Q", f.read(8))
+        (num_doc_indices,) = struct.unpack("<Q", f.read(8))
+        offset = f.tell()
+    buffer = np.memmap(index_file, dtype=np.uint8, mode="r")
+    sizes = np.frombuffer(buffer, dtype=np.int32, count=num_sequences, offset=offset)
+    offset += sizes.nbytes
+    pointers = np.frombuffer(buffer, dtype=np.int64, count=num_sequences, offset=offset)
+    offset += pointers.nbytes
+    doc_idx = np.frombuffer(
+        buffer, dtype=np.int64, count=num_doc_indices, offset=offset
+    )
+    return CODE_DTYPES[code], sizes, pointers, doc_idx
+
+
+class IndexedDatasetBuilder:
+    """Writes documents of token IDs to `{prefix}.bin` and `{prefix}.idx` in the format
+    of Megatron-LM's MMapIndexedDataset, one sequence per document.
+
+    The token IDs are appended to the .bin file as they are added, while only the
+    sizes of the documents (4 bytes per document) are kept in memory until `close`
+    writes the .idx file. With `append`, the new documents are added after those of
+    the existing files. Documents added by a builder that is not closed, e.g., because
+    of an exception in its `with` block, are not recorded in the .idx file, and the
+    .bin file is cut back to the recorded ones when it is appended to again.
+    """
+
+    def __init__(
+        self,
+        prefix: pathlib.Path,
+        dtype: Union[np.dtype, type],
+        append: bool = False,
+    ) -> None:
+        self.prefix = prefix
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in DTYPE_CODES:
+            raise ValueError(f"{self.dtype} is not supported by Megatron-LM.")
+        self._sizes: list[np.ndarray] = []
+        self._bin: BinaryIO
+        bin_file = get_bin_file(prefix)
+        index_file = get_index_file(prefix)
+        if append and index_file.exists():
+            dtype, sizes, _, _ = read_index(index_file)
+            if dtype != self.dtype:
+                raise ValueError(f"{index_file} has token IDs of {dtype}.")
+            self._sizes.append(np.array(sizes))
+            num_bytes = int(sizes.sum(dtype=np.int64)) * self.dtype.itemsize
+            logger.info(f"Appending to {len(sizes):,} documents in {bin_file}.")
+            self._bin = bin_file.open("r+b")
+            self._bin.truncate(num_bytes)
+            self._bin.seek(num_bytes)
+        else:
+            index_file.unlink(missing_ok=True)
+            self._bin = bin_file.open("wb")
+        self._max_id: Optional[int] = None
+        if self.dtype.kind in "iu":
+            self._max_id = int(np.iinfo(self.dtype).max)
+
+    def __enter__(self) -> "IndexedDatasetBuilder":
+        return self
+
+    def __exit__(self, exc_type: Any, *args: Any) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self._bin.close()
+
+    def add_document(self, token_ids: Union[Sequence[int], np.ndarray]) -> None:
+        self._write(np.asarray(token_ids))
+        self._sizes.append(np.array([len(token_ids)], dtype=np.int32))
+
+    def add_documents(self, token_ids: Union[pa.ListArray, pa.ChunkedArray]) -> None:
+        """Adds the documents of a list column of token IDs, e.g., the `token_ids` of
+        a tokenized dataset, without converting them to Python objects."""
+        if isinstance(token_ids, pa.ChunkedArray):
+            chunks = token_ids.chunks
+        else:
+            chunks = [token_ids]
+        for chunk in chunks:
+            self._write(chunk.flatten().to_numpy(zero_copy_only=False))
+            sizes = pc.list_value_length(chunk).fill_null(0)
+            self._sizes.append(sizes.to_numpy().astype(np.int32))
+
+    def _write(self, token_ids: np.ndarray) -> None:
+        if self._max_id is not None and token_ids.size > 0:
+            if token_ids.min() < 0 or token_ids.max() > self._max_id:
+                raise ValueError(f"The token IDs do not fit in {self.dtype}.")
+        self._bin.write(token_ids.astype(self.dtype, copy=False).tobytes(order="C"))
+
+    def close(self) -> None:
+        """Writes the .idx file. It is written under a temporary name and renamed, so
+        an existing one stays intact until then."""
+        self._bin.close()
+        if self._sizes:
+            sizes = np.concatenate(self._sizes)
+        else:
+            sizes = np.zeros(0, dtype=np.int32)
+        pointers = np.zeros(len(sizes), dtype=np.int64)
+        np.cumsum(sizes[:-1], dtype=np.int64, out=pointers[1:])
+        pointers *= self.dtype.itemsize
+        doc_idx = np.arange(len(sizes) + 1, dtype=np.int64)
+
+        index_file = get_index_file(self.prefix)
+        temporary_file = get_temporary_file(index_file)
+        with temporary_file.open("wb") as f:
+            f.write(INDEX_MAGIC)
+            f.write(struct.pack("<Q", INDEX_VERSION))
+            f.write(struct.pack("<B", DTYPE_CODES[self.dtype]))
+            f.write(struct.pack("<Q", len(sizes)))
+            f.write(struct.pack("<Q", len(doc_idx)))
+            f.write(sizes.tobytes(order="C"))
+            f.write(pointers.tobytes(order="C"))
+            f.write(doc_idx.tobytes(order="C"))
+        os.replace(temporary_file, index_file)
+        logger.info(
+            f"Wrote {len(sizes):,} documents of {int(sizes.sum(dtype=np.int64)):,} "
+            f"tokens to {get_bin_file(self.prefix)}."
+        )
+
+
+class IndexedDataset:
+    """Reads the documents of token IDs written by `IndexedDatasetBuilder` (or
+    Megatron-LM). Both files are memory-mapped, and a document is returned as a view of
+    the .bin file, so nothing is read until it is accessed."""
+
+    def __init__(self, prefix: Union[str, pathlib.Path]) -> None:
+        self.prefix = pathlib.Path(prefix)
+        self.dtype, self.sizes, self.pointers, self.doc_idx = read_index(
+            get_index_file(self.prefix)
+        )
+        bin_file = get_bin_file(self.prefix)
+        self._bin: np.ndarray
+        if bin_file.stat().st_size > 0:
+            self._bin = np.memmap(bin_file, dtype=self.dtype, mode="r")
+        else:
+            # An empty file cannot be memory-mapped.
+            self._bin = np.zeros(0, dtype=self.dtype)
+
+    def __len__(self) -> int:
+        return len(self.sizes)
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        return self.get(index)
+
+    def get(
+        self, index: int, offset: int = 0, length: Optional[int] = None
+    ) -> np.ndarray:
+        """Returns the token IDs of the `index`-th document from `offset`, up to `length`
+        tokens."""
+        size = int(self.sizes[index])
+        start = int(self.pointers[index]) // self.dtype.itemsize + offset
+        end = start + (size - offset if length is None else min(length, size - offset))
+        return self._bin[start:end]
+
+    @property
+    def num_tokens(self) -> int:
+        return int(self.sizes.sum(dtype=np.int64))
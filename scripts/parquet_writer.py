@@ -0,0 +1,303 @@
+import json
+import logging
+import os
+import pathlib
+import queue
+import threading
+from typing import Any, Optional, Union
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+
+Batch = Union[dict[str, list[Any]], pa.RecordBatch, pa.Table]
+
+
+class ParquetShardWriter:
+    """Writes batches of examples to `{output_dir}/{prefix}_{index}.parquet`.
+
+    A new file is started once the current one has `max_rows` rows, `max_bytes` bytes
+    (uncompressed, as in memory), or `max_tokens` tokens (the sum of `num_tokens`),
+    whichever comes first. A batch is split to fit `max_rows` exactly, while the other
+    limits may be exceeded by up to a batch. Batches are buffered into row groups of
+    `row_group_size` rows, and converted to Arrow, compressed, and written on a
+    background thread, so the caller can go on producing the next batches. A file is
+    written under a temporary name and renamed once complete.
+
+    A file that already exists is kept unless `overwrite`, and the examples that would go
+    into it are discarded, so the following files are the same as in a run from scratch.
+
+    With `manifest_file`, every completed file is appended to it as a JSON line with
+    where to resume: the `position` of the input given with the last batch before the
+    end of the file, and the number of examples after it that are in the file
+    (`num_written`). Unless `overwrite`, a writer with an existing manifest continues
+    from the file after the last one in it. The caller is expected to skip the input up
+    to `resume_position` and give the same batches from there, and the first
+    `num_written` examples are discarded.
+    """
+
+    def __init__(
+        self,
+        output_dir: pathlib.Path,
+        prefix: str,
+        row_group_size: int = 10_000,
+        compression: str = "snappy",
+        compression_level: Optional[int] = None,
+        max_rows: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        max_tokens: Optional[int] = None,
+        overwrite: bool = False,
+        manifest_file: Optional[pathlib.Path] = None,
+        queue_size: int = 8,
+    ) -> None:
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.compression_level = compression_level
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_tokens = max_tokens
+        self.overwrite = overwrite
+        self.manifest_file = manifest_file
+        self.output_files: list[pathlib.Path] = []
+        # The position of the input to resume from, if any.
+        self.resume_position: Any = None
+
+        # The index of the next file, and the current file if any.
+        self._file_index = 0
+        self._output_file: Optional[pathlib.Path] = None
+        self._writer: Optional[pq.ParquetWriter] = None
+        self._schema: Optional[pa.Schema] = None
+        self._skipping = False
+        self._num_rows = 0
+        self._num_bytes = 0
+        self._num_tokens = 0
+        self._buffer: list[pa.Table] = []
+        self._num_buffered_rows = 0
+        # The position given with the last batch, and the number of examples of the
+        # current batch added to the files.
+        self._position: Any = None
+        self._num_consumed = 0
+        self._num_to_discard = 0
+        if manifest_file is not None:
+            self._load_manifest(manifest_file)
+
+        self._queue: queue.Queue[Optional[tuple[Batch, Any]]] = queue.Queue(
+            maxsize=queue_size
+        )
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self) -> "ParquetShardWriter":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def write(self, batch: Batch, position: Any = None) -> None:
+        """Queues `batch` to be written. Blocks while the queue is full. `position` is
+        recorded in the manifest as the input consumed up to the end of `batch`, and
+        should be JSON serializable."""
+        self._raise_error()
+        self._queue.put((batch, position))
+
+    def close(self) -> None:
+        """Writes the remaining examples and waits for the background thread."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise RuntimeError("Failed to write the parquet files.") from self._error
+
+    def _load_manifest(self, manifest_file: pathlib.Path) -> None:
+        if self.overwrite:
+            manifest_file.unlink(missing_ok=True)
+            return
+        entries = read_manifest(manifest_file)
+        if not entries:
+            return
+        entry = entries[-1]
+        logger.info(f"Resuming after {entry['file']} as recorded in {manifest_file}.")
+        self._file_index = entry["index"] + 1
+        self._position = self.resume_position = entry["position"]
+        self._num_to_discard = entry["num_written"]
+
+    def _run(self) -> None:
+        closed = False
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    closed = True
+                    break
+                batch, position = item
+                if isinstance(batch, dict):
+                    self._add(pa.Table.from_pydict(batch))
+                elif isinstance(batch, pa.RecordBatch):
+                    self._add(pa.Table.from_batches([batch]))
+                else:
+                    self._add(batch)
+                self._position = position
+                self._num_consumed = 0
+            self._close_file()
+        except BaseException as e:
+            self._error = e
+            # Unblock the producer waiting for space in the queue until it closes.
+            while not closed:
+                closed = self._queue.get() is None
+
+    def _add(self, table: pa.Table) -> None:
+        if self._num_to_discard > 0:
+            num_rows = min(table.num_rows, self._num_to_discard)
+            table = table.slice(num_rows)
+            self._num_to_discard -= num_rows
+            self._num_consumed += num_rows
+        while table.num_rows > 0:
+            if self._output_file is None or self._is_full():
+                self._open_file()
+            if self.max_rows is not None:
+                num_rows = min(table.num_rows, self.max_rows - self._num_rows)
+            else:
+                num_rows = table.num_rows
+            head, table = table.slice(0, num_rows), table.slice(num_rows)
+            if self._schema is not None and head.schema != self._schema:
+                head = self._unify_schema(head)
+            self._num_rows += head.num_rows
+            self._num_bytes += head.nbytes
+            if "num_tokens" in head.column_names:
+                self._num_tokens += pc.sum(head["num_tokens"]).as_py() or 0
+            self._num_consumed += head.num_rows
+            if self._skipping:
+                continue
+            if self._schema is None:
+                self._schema = head.schema
+            self._buffer.append(head)
+            self._num_buffered_rows += head.num_rows
+            if self._num_buffered_rows >= self.row_group_size:
+                self._flush()
+
+    def _unify_schema(self, table: pa.Table) -> pa.Table:
+        """Casts `table` to the schema of the current file. Until the file is created,
+        the buffered tables may be cast to the schema of `table` instead, e.g., when a
+        field was null in all the examples so far. If neither is possible, a new file is
+        started."""
+        try:
+            return table.cast(self._schema)
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError, ValueError):
+            pass
+        if self._writer is None:
+            try:
+                self._buffer = [
+                    buffered.cast(table.schema) for buffered in self._buffer
+                ]
+                self._schema = table.schema
+                return table
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError, ValueError):
+                pass
+        logger.warning(
+            f"The schema changed from {self._schema} to {table.schema}, so a new file "
+            "is started."
+        )
+        self._open_file()
+        return table
+
+    def _is_full(self) -> bool:
+        return (
+            (self.max_rows is not None and self._num_rows >= self.max_rows)
+            or (self.max_bytes is not None and self._num_bytes >= self.max_bytes)
+            or (self.max_tokens is not None and self._num_tokens >= self.max_tokens)
+        )
+
+    def _open_file(self) -> None:
+        self._close_file()
+        self._num_rows = 0
+        self._num_bytes = 0
+        self._num_tokens = 0
+        self._schema = None
+        self._output_file = self.output_dir.joinpath(
+            f"{self.prefix}_{self._file_index}.parquet"
+        )
+        self._file_index += 1
+        self._skipping = self._output_file.exists() and not self.overwrite
+        if self._skipping:
+            logger.error(
+                f"{self._output_file} already exists. Specify --overwrite to overwrite."
+            )
+        else:
+            self.output_files.append(self._output_file)
+
+    def _flush(self, final: bool = False) -> None:
+        """Writes the buffered examples in row groups of `row_group_size` rows. The
+        rest stay in the buffer unless `final`."""
+        if not self._buffer:
+            return
+        assert self._output_file is not None and self._schema is not None
+        table = pa.concat_tables(self._buffer)
+        if final:
+            num_rows = table.num_rows
+        else:
+            num_rows = table.num_rows // self.row_group_size * self.row_group_size
+        if num_rows == 0:
+            return
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(
+                get_temporary_file(self._output_file),
+                self._schema,
+                compression=self.compression,
+                compression_level=self.compression_level,
+            )
+        self._writer.write_table(
+            table.slice(0, num_rows), row_group_size=self.row_group_size
+        )
+        self._buffer = [table.slice(num_rows)] if num_rows < table.num_rows else []
+        self._num_buffered_rows = table.num_rows - num_rows
+
+    def _close_file(self) -> None:
+        if self._output_file is None:
+            return
+        self._flush(final=True)
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            os.replace(get_temporary_file(self._output_file), self._output_file)
+        if self.manifest_file is not None:
+            entry = {
+                "index": self._file_index - 1,
+                "file": self._output_file.name,
+                "num_rows": self._num_rows,
+                "position": self._position,
+                "num_written": self._num_consumed,
+            }
+            with self.manifest_file.open("a") as f:
+                f.write(json.dumps(entry) + "\n")
+        self._output_file = None
+
+
+def get_temporary_file(output_file: pathlib.Path) -> pathlib.Path:
+    """Returns the name an output file is written under until it is complete, which
+    does not match `*.parquet`."""
+    return output_file.with_name(f"{output_file.name}.tmp")
+
+
+def read_manifest(manifest_file: pathlib.Path) -> list[dict[str, Any]]:
+    """Reads the entries of a JSONL manifest, if it exists. A line cut off by an
+    interruption is removed from the file so that entries can be appended to it."""
+    if not manifest_file.exists():
+        return []
+    lines = manifest_file.read_text().splitlines(keepends=True)
+    entries: list[dict[str, Any]] = []
+    for line in lines:
+        try:
+            entries.append(json.loads(line))
+        except json.JSONDecodeError:
+            logger.warning(f"Ignoring a broken line of {manifest_file}.")
+    if len(entries) < len(lines) or (lines and not lines[-1].endswith("\n")):
+        manifest_file.write_text("".join(json.dumps(entry) + "\n" for entry in entries))
+    return entries
@@ -1,21 +1,24 @@
+import functools
 import logging
+import os
 import pathlib
-import random
 from argparse import ArgumentParser
+from multiprocessing import Pool
 from typing import Union
 
-from datasets import Dataset, DatasetDict, disable_caching
+import numpy as np
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from count_tokens import TOKEN_COLUMNS
+from datasets import Dataset, disable_caching
 from datasets.splits import Split
 from utils import list_input_files
 
 logger = logging.getLogger(__name__)
 disable_caching()
 
-random.seed(42)
-
 CHUNK_SIZE = 100_000
-# This value should be as large as possible but no greater than the value in the respective corpus.
-NUM_TOKENS_PER_EXAMPLE = 500
+SEED = 42
 
 
 def main() -> None:
@@ -48,6 +51,12 @@ def main() -> None:
         default="10M",
         help="Validation token size.",
     )
+    parser.add_argument(
+        "--num_proc",
+        type=int,
+        default=-1,
+        help="Number of processes for parallel execution.",
+    )
     parser.add_argument(
         "--output_format",
         type=str,
@@ -71,59 +80,138 @@ def main() -> None:
     input_files = sorted(list_input_files(args.input_path))
     if not input_files:
         return
-    random.shuffle(input_files)
 
-    num_valid_examples_per_shard = int(
-        valid_token_size / NUM_TOKENS_PER_EXAMPLE / len(input_files)
+    num_proc = os.cpu_count() if args.num_proc == -1 else args.num_proc
+    with Pool(num_proc) as pool:
+        num_tokens = pool.map(read_num_tokens, input_files)
+        train_indices, valid_indices = plan_samples(
+            num_tokens, train_token_size, valid_token_size
+        )
+        pool.starmap(
+            functools.partial(
+                extract_samples,
+                output_dir=output_dir,
+                output_format=args.output_format,
+                overwrite=args.overwrite,
+            ),
+            zip(input_files, train_indices, valid_indices),
+        )
+
+    cur_train_token_size = sum(
+        int(sizes[indices].sum()) for sizes, indices in zip(num_tokens, train_indices)
+    )
+    cur_valid_token_size = sum(
+        int(sizes[indices].sum()) for sizes, indices in zip(num_tokens, valid_indices)
     )
-
-    cur_train_token_size: int = 0
-    cur_valid_token_size: int = 0
-    output_file: pathlib.Path
-    for input_file in input_files:
-        dataset: Dataset = Dataset.from_parquet(str(input_file), keep_in_memory=True)
-        if cur_valid_token_size < valid_token_size:
-            dataset_split: DatasetDict = dataset.train_test_split(
-                test_size=num_valid_examples_per_shard, shuffle=True, seed=42
-            )
-            train_dataset = dataset_split[Split.TRAIN]
-            valid_dataset = dataset_split[Split.TEST]
-        else:
-            # Use all the data for training.
-            train_dataset = dataset
-            valid_dataset = Dataset.from_dict({})
-        if cur_train_token_size < train_token_size:
-            output_file = output_dir / f"{input_file.stem}.{args.output_format}"
-            save_dataset(
-                train_dataset,
-                output_file,
-                args.overwrite,
-                args.output_format,
-            )
-            cur_train_token_size += sum(train_dataset["num_tokens"])
-        if cur_valid_token_size < valid_token_size:
-            output_file = (
-                output_dir
-                / f"{input_file.stem.replace(str(Split.TRAIN), str(Split.VALIDATION))}.{args.output_format}"
-            )
-            save_dataset(
-                valid_dataset,
-                output_file,
-                args.overwrite,
-                args.output_format,
-            )
-            cur_valid_token_size += sum(valid_dataset["num_tokens"])
-
-        if (
-            cur_train_token_size >= train_token_size
-            and cur_valid_token_size >= valid_token_size
-        ):
-            break
-
     logger.info(f"Finished extracting train data of {cur_train_token_size:,} tokens.")
     logger.info(f"Finished extracting valid data of {cur_valid_token_size:,} tokens.")
 
 
+def read_num_tokens(input_file: pathlib.Path) -> np.ndarray:
+    """Returns the number of tokens of each example of a file, reading only the
+    `num_tokens` column (or the lengths of `token_ids` or `tokens` without it)."""
+    column_names = pq.read_schema(input_file).names
+    column = next((name for name in TOKEN_COLUMNS if name in column_names), None)
+    if column is None:
+        raise ValueError(f"{input_file} has none of {TOKEN_COLUMNS}.")
+    values = pq.read_table(input_file, columns=[column])[column]
+    if column != "num_tokens":
+        values = pc.list_value_length(values)
+    return values.to_numpy().astype(np.int64)
+
+
+def select_by_token_size(
+    sizes: np.ndarray, order: np.ndarray, token_size: Union[int, float]
+) -> np.ndarray:
+    """Returns a mask of the examples taken in `order` as long as they fit in
+    `token_size` tokens, skipping those that do not fit in what is left, so that the
+    total is `token_size` unless no remaining example fits."""
+    selected = np.zeros(len(sizes), dtype=bool)
+    while len(order) > 0:
+        # Only the examples that fit can be taken, and the running total of those
+        # is taken up to the first one that does not fit any more.
+        order = order[sizes[order] <= token_size]
+        cumulative_sizes = np.cumsum(sizes[order])
+        num_fitting = int(np.searchsorted(cumulative_sizes, token_size, side="right"))
+        selected[order[:num_fitting]] = True
+        if num_fitting > 0:
+            token_size -= int(cumulative_sizes[num_fitting - 1])
+        order = order[num_fitting + 1 :]
+    return selected
+
+
+def plan_samples(
+    num_tokens: list[np.ndarray],
+    train_token_size: Union[int, float],
+    valid_token_size: int,
+) -> tuple[list[np.ndarray], list[np.ndarray]]:
+    """Chooses the train and validation examples of every file from the numbers of
+    their tokens. The examples are taken in a random order over all the files until
+    each token size is reached, so every file contributes in proportion to its size.
+    Returns the sorted indices of the train and the validation examples of each
+    file."""
+    sizes = np.concatenate(num_tokens)
+    order = np.random.default_rng(SEED).permutation(len(sizes))
+    is_valid = select_by_token_size(sizes, order, valid_token_size)
+    if train_token_size == float("inf"):
+        is_train = ~is_valid
+    else:
+        is_train = select_by_token_size(
+            sizes, order[~is_valid[order]], train_token_size
+        )
+    total_token_size = int(sizes.sum())
+    requested_token_size = valid_token_size
+    if train_token_size != float("inf"):
+        requested_token_size += int(train_token_size)
+    if total_token_size < requested_token_size:
+        logger.warning(
+            f"The data has only {total_token_size:,} tokens for the requested "
+            f"{requested_token_size:,} tokens."
+        )
+    offsets = np.cumsum([0] + [len(sizes) for sizes in num_tokens])
+    train_indices = [
+        np.flatnonzero(is_train[start:end]) for start, end in zip(offsets, offsets[1:])
+    ]
+    valid_indices = [
+        np.flatnonzero(is_valid[start:end]) for start, end in zip(offsets, offsets[1:])
+    ]
+    return train_indices, valid_indices
+
+
+def extract_samples(
+    input_file: pathlib.Path,
+    train_indices: np.ndarray,
+    valid_indices: np.ndarray,
+    output_dir: pathlib.Path,
+    output_format: str,
+    overwrite: bool,
+) -> None:
+    """Writes the examples of a file at the indices to the train and validation files,
+    or nothing if no example of it is chosen."""
+    if len(train_indices) == 0 and len(valid_indices) == 0:
+        return
+    table = pq.read_table(input_file)
+    if len(train_indices) > 0:
+        output_file = output_dir / f"{input_file.stem}.{output_format}"
+        save_dataset(
+            Dataset(table.take(train_indices)),
+            output_file,
+            overwrite,
+            output_format,
+        )
+    if len(valid_indices) > 0:
+        output_file = (
+            output_dir
+            / f"{input_file.stem.replace(str(Split.TRAIN), str(Split.VALIDATION))}.{output_format}"
+        )
+        save_dataset(
+            Dataset(table.take(valid_indices)),
+            output_file,
+            overwrite,
+            output_format,
+        )
+
+
 def canonicalize_number(number: str) -> int:
     if number.endswith("k") or number.endswith("K"):
         return int(number[:-1]) * 1_000
@@ -1,10 +1,21 @@
+import functools
 import logging
+import os
 import pathlib
 import random
 from argparse import ArgumentParser
+from multiprocessing import Pool
+from typing import BinaryIO, Optional
 
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from datasets import Dataset, DatasetDict, disable_caching
 from datasets.splits import Split
+from extract_ids import get_example_digests
+from parquet_writer import get_temporary_file
+from tqdm import tqdm
 from utils import list_input_files
 
 logger = logging.getLogger(__name__)
@@ -12,6 +23,9 @@ disable_caching()
 
 random.seed(42)
 
+# Number of examples read and split at a time by `split_file_by_hash`
+HASH_SPLIT_BATCH_SIZE = 10_000
+
 
 def main() -> None:
     parser = ArgumentParser()
@@ -37,6 +51,31 @@ def main() -> None:
         default="81",
         help="Number of validation examples per shard.",
     )
+    parser.add_argument(
+        "--valid_fraction",
+        type=float,
+        default=None,
+        help=(
+            "Fraction of the examples to assign to the validation set by the hash of "
+            "their IDs, instead of --valid_examples_per_shard at random."
+        ),
+    )
+    parser.add_argument(
+        "--id_key",
+        type=str,
+        default="hash",
+        help=(
+            'Key of the IDs hashed with --valid_fraction: "hash" for the text, or a '
+            'field of `meta`, e.g., "id" for ja_wiki and en_wiki and "hexsha" for '
+            "code_stack."
+        ),
+    )
+    parser.add_argument(
+        "--num_proc",
+        type=int,
+        default=1,
+        help="Number of processes for parallel execution with --valid_fraction.",
+    )
     parser.add_argument(
         "--output_format",
         type=str,
@@ -45,6 +84,8 @@ def main() -> None:
         help="Output format.",
     )
     args = parser.parse_args()
+    if args.valid_fraction is not None and not 0.0 <= args.valid_fraction <= 1.0:
+        parser.error("--valid_fraction should be in [0, 1].")
 
     output_dir: pathlib.Path = pathlib.Path(args.output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
@@ -54,6 +95,18 @@ def main() -> None:
         return
     random.shuffle(input_files)
 
+    if args.valid_fraction is not None:
+        split_files_by_hash(
+            input_files,
+            args.id_key,
+            args.valid_fraction,
+            output_dir,
+            args.output_format,
+            args.overwrite,
+            args.num_proc,
+        )
+        return
+
     valid_examples_per_shard: int = canonicalize_number(args.valid_examples_per_shard)
 
     train_token_size: int = 0
@@ -100,6 +153,155 @@ def main() -> None:
     )
 
 
+def is_validation(digests: np.ndarray, valid_fraction: float) -> np.ndarray:
+    """Returns whether each example goes to the validation set, which is when the first
+    64 bits of the digest of its ID (`extract_ids.get_example_digests`) are below
+    `valid_fraction` of 2^64. It only depends on the ID, so an example is on the same
+    side in any run, and raising `valid_fraction` only moves examples to the
+    validation set."""
+    if valid_fraction >= 1.0:
+        return np.ones(len(digests), dtype=bool)
+    if len(digests) == 0:
+        return np.zeros(0, dtype=bool)
+    keys = np.ascontiguousarray(digests).view(">u8").reshape(len(digests), -1)[:, 0]
+    return keys < np.uint64(int(valid_fraction * 2**64))
+
+
+class SplitWriter:
+    """Writes tables to a parquet or JSONL file as they come, under a temporary name
+    that is renamed once complete."""
+
+    def __init__(
+        self, output_file: pathlib.Path, format: str, schema: pa.Schema
+    ) -> None:
+        self.output_file = output_file
+        self.format = format
+        self.schema = schema
+        self._temporary_file = get_temporary_file(output_file)
+        self._parquet_writer: Optional[pq.ParquetWriter] = None
+        self._jsonl_file: Optional[BinaryIO] = None
+
+    def write(self, table: pa.Table) -> None:
+        if self.format == "jsonl":
+            if self._jsonl_file is None:
+                self._jsonl_file = self._temporary_file.open("wb")
+            Dataset(table).to_json(self._jsonl_file, force_ascii=False)
+        else:
+            assert self.format == "parquet"
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(
+                    self._temporary_file, self.schema
+                )
+            self._parquet_writer.write_table(table)
+
+    def close(self) -> None:
+        if self._jsonl_file is not None:
+            self._jsonl_file.close()
+        elif self._parquet_writer is not None:
+            self._parquet_writer.close()
+        elif self.format == "jsonl":
+            # Nothing was written, as the input has no examples.
+            self._temporary_file.touch()
+        else:
+            # A parquet file with no rows still needs the schema to be read.
+            pq.write_table(self.schema.empty_table(), self._temporary_file)
+        os.replace(self._temporary_file, self.output_file)
+
+
+def split_file_by_hash(
+    input_file: pathlib.Path,
+    id_key: str,
+    valid_fraction: float,
+    output_dir: pathlib.Path,
+    output_format: str,
+    overwrite: bool,
+) -> tuple[Optional[int], Optional[int], int, int]:
+    """Splits a file by `is_validation` in batches of `HASH_SPLIT_BATCH_SIZE` examples,
+    so the memory does not depend on the size of the file. Returns the numbers of the
+    train and validation tokens (None without `num_tokens`) and examples."""
+    train_file = output_dir / f"{input_file.stem}.{output_format}"
+    valid_file = (
+        output_dir
+        / f"{input_file.stem.replace(str(Split.TRAIN), str(Split.VALIDATION))}.{output_format}"
+    )
+    if not overwrite and (train_file.exists() or valid_file.exists()):
+        logger.error(
+            f"{train_file} or {valid_file} already exists. Specify --overwrite to "
+            "overwrite."
+        )
+        return None, None, 0, 0
+
+    parquet_file = pq.ParquetFile(input_file)
+    has_num_tokens = "num_tokens" in parquet_file.schema_arrow.names
+    train_token_size = valid_token_size = train_example_size = valid_example_size = 0
+    train_writer = SplitWriter(train_file, output_format, parquet_file.schema_arrow)
+    valid_writer = SplitWriter(valid_file, output_format, parquet_file.schema_arrow)
+    for batch in parquet_file.iter_batches(batch_size=HASH_SPLIT_BATCH_SIZE):
+        table = pa.Table.from_batches([batch])
+        is_valid = pa.array(
+            is_validation(get_example_digests(table, id_key), valid_fraction)
+        )
+        train_table = table.filter(pc.invert(is_valid))
+        valid_table = table.filter(is_valid)
+        train_writer.write(train_table)
+        valid_writer.write(valid_table)
+        train_example_size += train_table.num_rows
+        valid_example_size += valid_table.num_rows
+        if has_num_tokens:
+            train_token_size += pc.sum(train_table["num_tokens"]).as_py() or 0
+            valid_token_size += pc.sum(valid_table["num_tokens"]).as_py() or 0
+    train_writer.close()
+    valid_writer.close()
+    if not has_num_tokens:
+        return None, None, train_example_size, valid_example_size
+    return train_token_size, valid_token_size, train_example_size, valid_example_size
+
+
+def split_files_by_hash(
+    input_files: list[pathlib.Path],
+    id_key: str,
+    valid_fraction: float,
+    output_dir: pathlib.Path,
+    output_format: str,
+    overwrite: bool,
+    num_proc: int,
+) -> None:
+    """Splits the files independently of each other by `split_file_by_hash`."""
+    with Pool(num_proc) as pool:
+        results = list(
+            tqdm(
+                pool.imap_unordered(
+                    functools.partial(
+                        split_file_by_hash,
+                        id_key=id_key,
+                        valid_fraction=valid_fraction,
+                        output_dir=output_dir,
+                        output_format=output_format,
+                        overwrite=overwrite,
+                    ),
+                    input_files,
+                ),
+                total=len(input_files),
+            )
+        )
+    train_example_size = sum(result[2] for result in results)
+    valid_example_size = sum(result[3] for result in results)
+    # The number of tokens is unknown if a file has no `num_tokens` or is skipped.
+    train_token_sizes = [result[0] for result in results]
+    valid_token_sizes = [result[1] for result in results]
+    train_tokens = valid_tokens = "an unknown number of"
+    if None not in train_token_sizes:
+        train_tokens = f"{sum(train_token_sizes):,}"
+    if None not in valid_token_sizes:
+        valid_tokens = f"{sum(valid_token_sizes):,}"
+    logger.info(
+        f"Finished extracting train data of {train_tokens} tokens, {train_example_size:,} examples."
+    )
+    logger.info(
+        f"Finished extracting valid data of {valid_tokens} tokens, {valid_example_size:,} examples."
+    )
+
+
 def canonicalize_number(number: str) -> int:
     if number.endswith("k") or number.endswith("K"):
         return int(number[:-1]) * 1_000
@@ -1,14 +1,22 @@
-import json
 import logging
 import pathlib
 import random
 from argparse import ArgumentParser
 from multiprocessing import Pool
-from typing import Any, Optional
+from typing import Optional
 
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from datasets import Dataset, disable_caching
 from datasets.splits import Split
-from extract_ids import get_example_id
+from extract_ids import (
+    ID_DIGEST_DTYPE,
+    get_example_digests,
+    is_in_id_index,
+    read_id_file,
+)
 from utils import list_input_files
 
 logger = logging.getLogger(__name__)
@@ -16,6 +24,16 @@ disable_caching()
 
 random.seed(42)
 
+# Sorted digests of the validation IDs, loaded in each worker by `load_id_index`
+validation_id_index: np.ndarray = np.zeros(0, dtype=ID_DIGEST_DTYPE)
+
+
+def load_id_index(valid_id_file: pathlib.Path) -> None:
+    """Initializes a worker with the validation IDs, which are memory-mapped from a
+    binary ID file rather than copied, whatever the start method of the pool."""
+    global validation_id_index
+    _, validation_id_index = read_id_file(valid_id_file)
+
 
 def main() -> None:
     parser = ArgumentParser()
@@ -39,7 +57,7 @@ def main() -> None:
         "--valid_id_file",
         type=str,
         default=None,
-        help="Validation ID file.",
+        help="Validation ID file (binary or JSON) written by extract_ids.py.",
     )
     parser.add_argument(
         "--output_format",
@@ -64,17 +82,16 @@ def main() -> None:
         return
     random.shuffle(input_files)
 
-    id_data: dict[str, Any] = json.loads(pathlib.Path(args.valid_id_file).read_text())
-    validation_ids: set[str] = set(id_data["ids"])
-    id_key = id_data["key"]
+    valid_id_file = pathlib.Path(args.valid_id_file)
+    id_key, id_index = read_id_file(valid_id_file)
+    logger.info(f"Loaded {len(id_index):,} validation IDs.")
 
-    with Pool(args.num_proc) as p:
+    with Pool(args.num_proc, initializer=load_id_index, initargs=(valid_id_file,)) as p:
         results = p.starmap(
             process_file,
             [
                 (
                     input_file,
-                    validation_ids,
                     id_key,
                     output_dir,
                     args.output_format,
@@ -101,40 +118,31 @@ def main() -> None:
 
 def process_file(
     input_file: pathlib.Path,
-    validation_ids: set[str],
     id_key: str,
     output_dir: pathlib.Path,
     output_format: str,
     overwrite: bool,
 ):
-    dataset: Dataset = Dataset.from_parquet(str(input_file), keep_in_memory=True)
-    train_examples = []
-    valid_examples = []
-    train_token_size: Optional[int] = 0
-    valid_token_size: Optional[int] = 0
-    train_example_size = valid_example_size = 0
-
-    for example in dataset:
-        if "num_tokens" not in example:
-            valid_token_size = train_token_size = None
-        id_ = get_example_id(example, id_key)
-        if id_ in validation_ids:
-            if valid_token_size is not None:
-                valid_token_size += example["num_tokens"]
-            valid_example_size += 1
-            valid_examples.append(example)
-        else:
-            if train_token_size is not None:
-                train_token_size += example["num_tokens"]
-            train_example_size += 1
-            train_examples.append(example)
-
-    train_dataset = Dataset.from_list(train_examples)
-    valid_dataset = Dataset.from_list(valid_examples)
+    """Splits a file by a mask of the examples whose IDs are in the validation IDs,
+    computed on the columns without converting the examples to Python objects."""
+    table: pa.Table = pq.read_table(input_file)
+    digests = get_example_digests(table, id_key)
+    is_valid = pa.array(is_in_id_index(digests, validation_id_index))
+    # Keep the types of the input, e.g., narrow integers of `token_ids`.
+    train_table = table.filter(pc.invert(is_valid))
+    valid_table = table.filter(is_valid)
+
+    train_token_size: Optional[int] = None
+    valid_token_size: Optional[int] = None
+    if "num_tokens" in table.column_names:
+        train_token_size = pc.sum(train_table["num_tokens"]).as_py() or 0
+        valid_token_size = pc.sum(valid_table["num_tokens"]).as_py() or 0
+    train_example_size = train_table.num_rows
+    valid_example_size = valid_table.num_rows
 
     output_file: pathlib.Path = output_dir / f"{input_file.stem}.{output_format}"
     save_dataset(
-        train_dataset,
+        Dataset(train_table),
         output_file,
         overwrite,
         output_format,
@@ -145,7 +153,7 @@ def process_file(
         / f"{input_file.stem.replace(str(Split.TRAIN), str(Split.VALIDATION))}.{output_format}"
     )
     save_dataset(
-        valid_dataset,
+        Dataset(valid_table),
         output_file,
         overwrite,
         output_format,
@@ -0,0 +1,72 @@
+from typing import Any
+
+import pyarrow as pa
+import pyarrow.compute as pc
+from filter_data import get_stages
+from filters import has_good_compression_ratio, has_valid_domain, is_not_empty
+from pipeline import FilterPipeline, Stage, get_stage_name
+
+
+def get_ja_cc_example(text: str, url: str = "https://example.jp/") -> dict[str, Any]:
+    return {"text": text, "meta": {"url": url}}
+
+
+def test_judges_reject_empty_text_and_missing_hostname() -> None:
+    assert not has_good_compression_ratio()(get_ja_cc_example(""))
+    assert not has_valid_domain()(get_ja_cc_example("テキスト", url="example"))
+
+
+def test_optimize_with_empty_text() -> None:
+    examples = [
+        get_ja_cc_example(""),
+        get_ja_cc_example("   "),
+        get_ja_cc_example("これは日本語の文章です。" * 20),
+        get_ja_cc_example("short", url="no hostname"),
+    ]
+    pipeline = FilterPipeline(get_stages("ja_cc"), ("text", "meta"))
+    pipeline.optimize(examples)
+    batch = {
+        "text": [e["text"] for e in examples],
+        "meta": [e["meta"] for e in examples],
+    }
+    outputs = pipeline(batch)
+    assert "" not in outputs["text"]
+    assert "   " not in outputs["text"]
+
+
+def test_optimize_keeps_order_of_failing_filters() -> None:
+    def get_length(example: dict[str, Any]) -> bool:
+        return 1 / len(example["text"]) < 1
+
+    guard = is_not_empty()
+    stages = [
+        Stage("filter", guard, get_stage_name(guard)),
+        Stage("filter", get_length, get_stage_name(get_length)),
+    ]
+    pipeline = FilterPipeline(stages, ("text",))
+    pipeline.optimize([{"text": ""}, {"text": "a"}, {"text": "ab"}])
+    assert [stage.fn for stage in pipeline.stages] == [guard, get_length]
+    assert pipeline({"text": ["", "a", "ab"]}) == {"text": ["ab"]}
+
+
+def test_report_of_vectorized_stages_has_no_latency() -> None:
+    def is_positive(example: dict[str, Any]) -> bool:
+        return example["n"] > 0
+
+    stages = [
+        Stage(
+            "filter",
+            is_positive,
+            "is_positive",
+            expression=lambda schema: pc.field("n") > 0,
+        ),
+        Stage("filter", is_not_empty(), "is_not_empty"),
+    ]
+    pipeline = FilterPipeline(stages, ("text", "n"), profile=True, vectorize=True)
+    table = pa.table({"text": ["a", "", "b"], "n": [1, 1, 0]})
+    pipeline(table.filter(pipeline.get_mask(table)).to_pydict())
+    vectorized, row = pipeline.get_report()
+    assert vectorized["num_output"] == 2 and vectorized["p50_ns"] is None
+    assert row["num_output"] == 1 and row["p50_ns"] > 0
+    cells = pipeline.format_report().splitlines()[2].split("|")
+    assert [cell.strip() for cell in cells[-3:]] == ["-", "-", "-"]
@@ -1,38 +1,105 @@
+import functools
+import itertools
 import logging
 import os
 import pathlib
 import time
 from argparse import ArgumentParser
-from typing import Any
+from collections.abc import Iterator
+from multiprocessing import Pool
+from typing import Any, Optional, Union
 
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import sentencepiece as spm
-from datasets import Dataset, disable_caching
+from datasets import Dataset, DatasetInfo, Features, Sequence, Value, disable_caching
+from indexed_dataset import (
+    IndexedDatasetBuilder,
+    get_bin_file,
+    get_index_file,
+    get_token_dtype,
+)
+from parquet_writer import get_temporary_file
 from tqdm import tqdm
-from utils import list_input_files
+from utils import list_input_files, read_jsonl_blocks
 
 logger = logging.getLogger(__name__)
 disable_caching()
 
+# Number of examples encoded at once by the threads of SentencePiece.
+ENCODE_BATCH_SIZE = 1_000
+# Size [bytes] of a block of the JSONL input parsed at a time when streaming
+BLOCK_SIZE = 16 * 2**20
+
 sentence_piece_processor: spm.SentencePieceProcessor
 
 
-def tokenize_examples(examples: dict[str, Any]) -> dict[str, Any]:
+def tokenize_examples(
+    examples: dict[str, Any], store_tokens: bool = True
+) -> dict[str, Any]:
     token_ids: list[list[int]] = sentence_piece_processor.encode_as_ids(
         examples["text"]
     )
-    return {
-        "tokens": [sentence_piece_processor.id_to_piece(ids) for ids in token_ids],
-        "token_ids": token_ids,
-        "num_tokens": [len(ids) for ids in token_ids],
-    }
+    outputs: dict[str, Any] = {}
+    if store_tokens:
+        outputs["tokens"] = [
+            sentence_piece_processor.id_to_piece(ids) for ids in token_ids
+        ]
+    outputs["token_ids"] = token_ids
+    outputs["num_tokens"] = [len(ids) for ids in token_ids]
+    return outputs
 
 
-def tokenize_file(
-    input_file: pathlib.Path,
-    input_format: str,
-    output_file: pathlib.Path,
-    num_proc: int,
-) -> None:
+def encode_examples(examples: dict[str, Any]) -> dict[str, Any]:
+    return {"token_ids": sentence_piece_processor.encode_as_ids(examples["text"])}
+
+
+@functools.lru_cache(maxsize=None)
+def get_piece_array() -> pa.Array:
+    """Returns the pieces of the vocabulary, indexed by their IDs."""
+    ids = list(range(sentence_piece_processor.get_piece_size()))
+    return pa.array(sentence_piece_processor.id_to_piece(ids), type=pa.string())
+
+
+def encode_texts(
+    texts: pa.ChunkedArray, num_threads: int, token_ids_dtype: str
+) -> pa.ListArray:
+    """Encodes `texts` on `num_threads` threads of SentencePiece, and returns the
+    token IDs as a list array built from flat buffers of all the examples."""
+    token_ids: list[list[int]] = sentence_piece_processor.encode(
+        texts.to_pylist(), out_type=int, num_threads=num_threads
+    )
+    offsets = np.zeros(len(token_ids) + 1, dtype=np.int32)
+    np.cumsum(
+        np.fromiter(map(len, token_ids), dtype=np.int32, count=len(token_ids)),
+        out=offsets[1:],
+    )
+    values = np.fromiter(
+        itertools.chain.from_iterable(token_ids), dtype=np.int32, count=offsets[-1]
+    )
+    # Arrow checks that the IDs fit in the type, unlike NumPy.
+    return pa.ListArray.from_arrays(offsets, pa.array(values).cast(token_ids_dtype))
+
+
+def tokenize_table(
+    table: pa.Table, num_threads: int, store_tokens: bool, token_ids_dtype: str
+) -> pa.Table:
+    """Appends the columns of `tokenize_examples` to `table`, without converting the
+    outputs to Python objects."""
+    token_ids = encode_texts(table["text"], num_threads, token_ids_dtype)
+    if store_tokens:
+        pieces = get_piece_array().take(token_ids.values)
+        table = table.append_column(
+            "tokens", pa.ListArray.from_arrays(token_ids.offsets, pieces)
+        )
+    table = table.append_column("token_ids", token_ids)
+    num_tokens = pc.list_value_length(token_ids).cast(pa.int64())
+    return table.append_column("num_tokens", num_tokens)
+
+
+def load_dataset(input_file: pathlib.Path, input_format: str) -> Dataset:
     logger.info(f"Loading {input_file}.")
     if input_format == "jsonl":
         dataset = Dataset.from_json(str(input_file), keep_in_memory=True)
@@ -44,21 +111,336 @@ def tokenize_file(
     else:
         assert input_format == "parquet"
         dataset = Dataset.from_parquet(str(input_file), keep_in_memory=True)
+    return dataset
+
+
+def iter_input_tables(
+    input_file: pathlib.Path, input_format: str, batch_size: int
+) -> Iterator[pa.Table]:
+    """Yields the examples of an input file in tables of up to `batch_size` rows,
+    reading a row group of parquet or a block of JSONL at a time."""
+    if input_format == "parquet":
+        parquet_file = pq.ParquetFile(input_file)
+        for record_batch in parquet_file.iter_batches(batch_size=batch_size):
+            yield pa.Table.from_batches([record_batch])
+    elif input_format == "jsonl":
+        file_size = input_file.stat().st_size
+        for table, _ in read_jsonl_blocks(input_file, 0, file_size, BLOCK_SIZE):
+            for start in range(0, table.num_rows, batch_size):
+                yield table.slice(start, batch_size)
+    else:
+        assert input_format == "pandas-jsonl"
+        import pandas as pd
+
+        for data_frame in pd.read_json(
+            str(input_file), lines=True, chunksize=batch_size
+        ):
+            yield pa.Table.from_pandas(data_frame, preserve_index=False)
+
+
+def get_token_ids_dtype(token_ids_dtype: str) -> str:
+    """Resolves "auto" to the narrowest Arrow type for the token IDs of the tokenizer."""
+    if token_ids_dtype != "auto":
+        return token_ids_dtype
+    return (
+        "uint16" if sentence_piece_processor.get_piece_size() <= 2**16 else "uint32"
+    )
+
+
+def add_tokens(dataset: Dataset, processor: spm.SentencePieceProcessor) -> Dataset:
+    """Returns `dataset` with `tokens` restored from `token_ids` whenever examples are
+    read, for the data tokenized with --drop_tokens."""
+
+    def transform(examples: dict[str, Any]) -> dict[str, Any]:
+        examples["tokens"] = [
+            processor.id_to_piece(ids) for ids in examples["token_ids"]
+        ]
+        return examples
+
+    return dataset.with_transform(transform)
+
+
+def get_tokenized_features(
+    features: Features, store_tokens: bool, token_ids_dtype: str
+) -> Features:
+    features = features.copy()
+    if store_tokens:
+        features["tokens"] = Sequence(Value("string"))
+    features["token_ids"] = Sequence(Value(token_ids_dtype))
+    features["num_tokens"] = Value("int64")
+    return features
+
+
+def tokenize_dataset(
+    dataset: Dataset, num_proc: int, store_tokens: bool, token_ids_dtype: str
+) -> Dataset:
+    features = get_tokenized_features(dataset.features, store_tokens, token_ids_dtype)
     logger.info("Tokenizing the dataset.")
     dataset = dataset.map(
         tokenize_examples,
         batched=True,
         batch_size=128,
+        features=features,
+        fn_kwargs={"store_tokens": store_tokens},
         keep_in_memory=True,
         num_proc=num_proc,
     )
     logger.info("Finished tokenizing the dataset.")
+    return dataset
+
+
+def tokenize_dataset_on_threads(
+    dataset: Dataset,
+    num_threads: int,
+    store_tokens: bool,
+    token_ids_dtype: str,
+    batch_size: int = ENCODE_BATCH_SIZE,
+) -> Dataset:
+    logger.info(f"Tokenizing the dataset on {num_threads} threads.")
+    table: pa.Table = dataset.data.table
+    tables = [
+        tokenize_table(
+            table.slice(start, batch_size),
+            num_threads,
+            store_tokens,
+            token_ids_dtype,
+        )
+        for start in range(0, table.num_rows, batch_size)
+    ]
+    if not tables:
+        tables = [tokenize_table(table, num_threads, store_tokens, token_ids_dtype)]
+    logger.info("Finished tokenizing the dataset.")
+    features = get_tokenized_features(dataset.features, store_tokens, token_ids_dtype)
+    # The metadata of the input describes only its own columns.
+    table = pa.concat_tables(tables).replace_schema_metadata(None)
+    return Dataset(table, info=DatasetInfo(features=features))
+
+
+def tokenize_file(
+    input_file: pathlib.Path,
+    input_format: str,
+    output_file: pathlib.Path,
+    num_proc: int,
+    store_tokens: bool = True,
+    token_ids_dtype: str = "int64",
+    num_threads: Optional[int] = None,
+    batch_size: int = ENCODE_BATCH_SIZE,
+) -> None:
+    dataset = load_dataset(input_file, input_format)
+    if num_threads is not None:
+        dataset = tokenize_dataset_on_threads(
+            dataset, num_threads, store_tokens, token_ids_dtype, batch_size
+        )
+    else:
+        dataset = tokenize_dataset(dataset, num_proc, store_tokens, token_ids_dtype)
 
     logger.info(f"Writing the tokenized data to {output_file}.")
-    dataset.to_parquet(output_file)
+    # Written under a temporary name so that an existing file is always complete.
+    dataset.to_parquet(get_temporary_file(output_file))
+    os.replace(get_temporary_file(output_file), output_file)
+    logger.info(f"Finished writing the tokenized to {output_file}.")
+
+
+def is_castable_without_loss(
+    schema: Union[pa.Schema, pa.DataType], reference: Union[pa.Schema, pa.DataType]
+) -> bool:
+    """Returns whether data of `schema` can be conformed to `reference` without
+    dropping anything, i.e., every field (including those of structs) is in
+    `reference` and has the same type, or only nulls. Fields of `reference` missing
+    from `schema` are filled with nulls by `conform_table`, but the values of lists
+    must have the same type."""
+    if isinstance(schema, pa.Schema) or pa.types.is_struct(schema):
+        if not (isinstance(reference, pa.Schema) or pa.types.is_struct(reference)):
+            return False
+        for field in schema:
+            index = reference.get_field_index(field.name)
+            if index == -1 or not is_castable_without_loss(
+                field.type, reference[index].type
+            ):
+                return False
+        return True
+    if pa.types.is_null(schema) or schema == reference:
+        return True
+    if pa.types.is_list(schema) and pa.types.is_list(reference):
+        return (
+            pa.types.is_null(schema.value_type)
+            or schema.value_type == reference.value_type
+        )
+    return False
+
+
+def conform_array(array: pa.Array, type_: pa.DataType) -> pa.Array:
+    """Casts `array` to `type_`, rebuilding structs by field name so that their
+    fields are in the order of `type_` and those missing from `array` are nulls."""
+    if not pa.types.is_struct(type_) or array.type == type_:
+        return array.cast(type_)
+    children = array.flatten()
+    fields = list(type_)
+    arrays = []
+    for field in fields:
+        index = array.type.get_field_index(field.name)
+        if index == -1:
+            arrays.append(pa.nulls(len(array), field.type))
+        else:
+            arrays.append(conform_array(children[index], field.type))
+    return pa.StructArray.from_arrays(arrays, fields=fields, mask=array.is_null())
+
+
+def conform_table(table: pa.Table, schema: pa.Schema) -> pa.Table:
+    """Returns `table` with the columns and types of `schema`, which the schema of
+    `table` must be castable to without loss (see `is_castable_without_loss`)."""
+    columns = []
+    for field in schema:
+        index = table.schema.get_field_index(field.name)
+        if index == -1:
+            columns.append(pa.nulls(table.num_rows, field.type))
+            continue
+        chunks = [conform_array(c, field.type) for c in table.column(index).chunks]
+        columns.append(pa.chunked_array(chunks, type=field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def tokenize_file_streaming(
+    input_file: pathlib.Path,
+    input_format: str,
+    output_file: pathlib.Path,
+    num_threads: int,
+    store_tokens: bool = True,
+    token_ids_dtype: str = "int64",
+    batch_size: int = ENCODE_BATCH_SIZE,
+) -> None:
+    """Tokenizes the input file in tables of `batch_size` examples, each written to the
+    output file before the next one is read. The types of the first table are used
+    for the whole file; fields that later tables lack are written as nulls."""
+    logger.info(f"Tokenizing {input_file} in batches of {batch_size:,} examples.")
+    temporary_file = get_temporary_file(output_file)
+    writer: Optional[pq.ParquetWriter] = None
+    completed = False
+    try:
+        for table in iter_input_tables(input_file, input_format, batch_size):
+            if writer is None:
+                input_schema = table.schema
+                features = get_tokenized_features(
+                    Features.from_arrow_schema(table.schema),
+                    store_tokens,
+                    token_ids_dtype,
+                )
+                schema = features.arrow_schema
+                writer = pq.ParquetWriter(temporary_file, schema)
+            elif not table.schema.equals(input_schema):
+                if not is_castable_without_loss(table.schema, input_schema):
+                    raise ValueError(
+                        f"The types of the examples of {input_file} change from "
+                        f"{input_schema} to {table.schema}, which cannot be written "
+                        "to the file started with the first types. Tokenize it "
+                        "without --streaming."
+                    )
+                table = conform_table(table, input_schema)
+            table = tokenize_table(table, num_threads, store_tokens, token_ids_dtype)
+            writer.write_table(table.cast(schema), row_group_size=batch_size)
+        completed = True
+    finally:
+        if writer is not None:
+            writer.close()
+        if not completed:
+            temporary_file.unlink(missing_ok=True)
+    if writer is None:
+        logger.warning(f"{input_file} has no examples and is skipped.")
+        return
+    os.replace(temporary_file, output_file)
     logger.info(f"Finished writing the tokenized to {output_file}.")
 
 
+def tokenize_file_to_indexed_dataset(
+    input_file: pathlib.Path,
+    input_format: str,
+    builder: IndexedDatasetBuilder,
+    num_proc: int,
+    num_threads: Optional[int] = None,
+    batch_size: int = ENCODE_BATCH_SIZE,
+) -> None:
+    if num_threads is not None:
+        # Only the token IDs are kept, so the input is always streamed.
+        logger.info(f"Tokenizing {input_file} on {num_threads} threads.")
+        for table in iter_input_tables(input_file, input_format, batch_size):
+            builder.add_documents(
+                encode_texts(table["text"], num_threads, str(builder.dtype))
+            )
+        return
+    dataset = load_dataset(input_file, input_format)
+    logger.info("Tokenizing the dataset.")
+    dataset = dataset.map(
+        encode_examples,
+        batched=True,
+        batch_size=128,
+        remove_columns=dataset.column_names,
+        keep_in_memory=True,
+        num_proc=num_proc,
+    )
+    logger.info(f"Adding the token IDs to {get_bin_file(builder.prefix)}.")
+    builder.add_documents(dataset.data.column("token_ids"))
+
+
+def tokenize_input_file(
+    input_file: pathlib.Path,
+    input_format: str,
+    output_dir: pathlib.Path,
+    output_format: str,
+    overwrite: bool,
+    num_proc: int,
+    store_tokens: bool = True,
+    token_ids_dtype: str = "int64",
+    num_threads: Optional[int] = None,
+    batch_size: int = ENCODE_BATCH_SIZE,
+    streaming: bool = False,
+) -> None:
+    """Tokenizes an input file to the file(s) of the same name in `output_dir`."""
+    if output_format == "megatron":
+        prefix = output_dir / input_file.stem
+        index_file = get_index_file(prefix)
+        if index_file.exists() and not overwrite:
+            logger.error(
+                f"{index_file} already exists. Specify --overwrite to overwrite."
+            )
+            return
+        dtype = get_token_dtype(sentence_piece_processor.get_piece_size())
+        with IndexedDatasetBuilder(prefix, dtype) as builder:
+            tokenize_file_to_indexed_dataset(
+                input_file,
+                input_format,
+                builder,
+                num_proc=num_proc,
+                num_threads=num_threads,
+                batch_size=batch_size,
+            )
+        return
+    output_file: pathlib.Path = output_dir / f"{input_file.stem}.parquet"
+    if output_file.exists() and not overwrite:
+        logger.error(f"{output_file} already exists. Specify --overwrite to overwrite.")
+        return
+    if streaming:
+        tokenize_file_streaming(
+            input_file,
+            input_format,
+            output_file,
+            num_threads=num_threads or 1,
+            store_tokens=store_tokens,
+            token_ids_dtype=token_ids_dtype,
+            batch_size=batch_size,
+        )
+        return
+    tokenize_file(
+        input_file,
+        input_format,
+        output_file,
+        num_proc=num_proc,
+        store_tokens=store_tokens,
+        token_ids_dtype=token_ids_dtype,
+        num_threads=num_threads,
+        batch_size=batch_size,
+    )
+
+
 def main() -> None:
     parser = ArgumentParser()
     parser.add_argument(
@@ -79,6 +461,49 @@ def main() -> None:
         type=str,
         help="Path to the output directory.",
     )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        default="parquet",
+        choices=["parquet", "megatron"],
+        help=(
+            'Output format. "megatron" writes only the token IDs to .bin and .idx '
+            "files in the format of Megatron-LM's MMapIndexedDataset."
+        ),
+    )
+    parser.add_argument(
+        "--output_prefix",
+        type=str,
+        default=None,
+        help=(
+            "Name of the .bin and .idx files in the output directory to write the "
+            'documents of all the input files to, for the "megatron" format. By '
+            "default, a pair of files is written for each input file."
+        ),
+    )
+    parser.add_argument(
+        "--append",
+        action="store_true",
+        help="Whether to append to the existing files of --output_prefix.",
+    )
+    parser.add_argument(
+        "--drop_tokens",
+        action="store_true",
+        help=(
+            "Whether not to store the pieces of the tokens (`tokens`), which are "
+            "restored from `token_ids` by `add_tokens` when needed."
+        ),
+    )
+    parser.add_argument(
+        "--token_ids_dtype",
+        type=str,
+        default="int64",
+        choices=["int64", "uint32", "uint16", "auto"],
+        help=(
+            'Type of `token_ids`. "auto" chooses uint16 or uint32 by the vocabulary '
+            "size."
+        ),
+    )
     parser.add_argument(
         "--sentencepiece_model",
         type=str,
@@ -95,6 +520,41 @@ def main() -> None:
         default=-1,
         help="Number of processes for parallel execution.",
     )
+    parser.add_argument(
+        "--num_threads",
+        type=int,
+        default=None,
+        help=(
+            "Number of threads of SentencePiece to encode large batches of texts in a "
+            "single process, instead of splitting the dataset among --num_proc "
+            "processes."
+        ),
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=ENCODE_BATCH_SIZE,
+        help="Number of examples encoded at once with --num_threads or --streaming.",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help=(
+            "Whether to read, tokenize, and write each file in batches of "
+            "--batch_size examples on --num_threads threads (1 by default), so that "
+            "the memory does not grow with the size of the file."
+        ),
+    )
+    parser.add_argument(
+        "--parallel_files",
+        action="store_true",
+        help=(
+            "Whether to tokenize the input files in parallel, a whole file per process "
+            "of a pool kept for the run, instead of splitting each file among "
+            "--num_proc new processes. This saves the start-up cost per file when "
+            "there are many of them."
+        ),
+    )
     args = parser.parse_args()
 
     output_dir: pathlib.Path = pathlib.Path(args.output_dir)
@@ -112,20 +572,60 @@ def main() -> None:
     if not input_files:
         return
 
-    logger.info("Loading the dataset")
-    for input_file in tqdm(input_files):
-        output_file: pathlib.Path = output_dir / f"{input_file.stem}.parquet"
-        if output_file.exists() and not args.overwrite:
+    num_proc: int = (os.cpu_count() or 1) if args.num_proc == -1 else args.num_proc
+    num_threads: Optional[int] = args.num_threads
+    if args.streaming and num_threads is None:
+        num_threads = 1
+    if args.output_format == "megatron" and args.output_prefix is not None:
+        if args.parallel_files:
+            parser.error("--parallel_files cannot be used with --output_prefix.")
+        dtype = get_token_dtype(sentence_piece_processor.get_piece_size())
+        logger.info(f"Writing the token IDs as {dtype}.")
+        prefix: pathlib.Path = output_dir / args.output_prefix
+        index_file = get_index_file(prefix)
+        if index_file.exists() and not args.append and not args.overwrite:
             logger.error(
-                f"{output_file} already exists. Specify --overwrite to overwrite."
+                f"{index_file} already exists. Specify --append to append to it or "
+                "--overwrite to overwrite."
             )
-            continue
-        tokenize_file(
-            input_file,
-            args.input_format,
-            output_file,
-            num_proc=os.cpu_count() if args.num_proc == -1 else args.num_proc,
+            return
+        with IndexedDatasetBuilder(prefix, dtype, append=args.append) as builder:
+            for input_file in tqdm(input_files):
+                tokenize_file_to_indexed_dataset(
+                    input_file,
+                    args.input_format,
+                    builder,
+                    num_proc=num_proc,
+                    num_threads=num_threads,
+                    batch_size=args.batch_size,
+                )
+    else:
+        tokenize = functools.partial(
+            tokenize_input_file,
+            input_format=args.input_format,
+            output_dir=output_dir,
+            output_format=args.output_format,
+            overwrite=args.overwrite,
+            store_tokens=not args.drop_tokens,
+            token_ids_dtype=get_token_ids_dtype(args.token_ids_dtype),
+            num_threads=num_threads,
+            batch_size=args.batch_size,
+            streaming=args.streaming,
         )
+        if args.parallel_files:
+            logger.info(f"Tokenizing {len(input_files)} files in {num_proc} processes.")
+            # The processes inherit the tokenizer, so it is loaded only once.
+            with Pool(num_proc) as pool:
+                for _ in tqdm(
+                    pool.imap_unordered(
+                        functools.partial(tokenize, num_proc=1), input_files
+                    ),
+                    total=len(input_files),
+                ):
+                    pass
+        else:
+            for input_file in tqdm(input_files):
+                tokenize(input_file, num_proc=num_proc)
 
     end_time = time.time()
     logger.info(
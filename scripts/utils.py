@@ -1,8 +1,12 @@
+import io
 import logging
 import pathlib
 from collections.abc import Iterator
 from typing import Literal
 
+import pyarrow as pa
+import pyarrow.json as paj
+
 logger = logging.getLogger(__name__)
 
 
@@ -16,3 +20,27 @@ def list_input_files(
             logger.warning(f"{path} not found and skipped")
             continue
         yield from path.glob(f"*.{input_format}") if path.is_dir() else [path]
+
+
+def read_jsonl_blocks(
+    input_file: pathlib.Path, start: int, end: int, block_size: int
+) -> Iterator[tuple[pa.Table, int]]:
+    """Yields the lines of `input_file` in [start, end) in tables of about `block_size`
+    bytes, each with the offset of its end. `start` and `end` should be at the beginning
+    of a line, and the blocks are the same from any offset yielded."""
+    with input_file.open("rb") as f:
+        f.seek(start)
+        offset = start
+        while offset < end:
+            data = f.read(min(block_size, end - offset))
+            if not data.endswith(b"\n"):
+                data += f.readline()
+            offset += len(data)
+            if data.strip() == b"":
+                continue
+            # The default blocks of the parser (1 MiB) keep the rows per block under
+            # its limit (100,000), and the types inferred from later blocks are
+            # promoted over the table.
+            yield paj.read_json(
+                io.BytesIO(data), read_options=paj.ReadOptions(use_threads=False)
+            ), offset